@@ -0,0 +1,10 @@
+CREATE TABLE `rasp_messages` (
+    `chat_id` VARCHAR(20) NOT NULL,
+    `message_id` INT UNSIGNED NOT NULL,
+    `type` ENUM('group', 'teacher', 'place', 'subject') NOT NULL,
+    `entity_id` INT UNSIGNED NOT NULL,
+    `date` DATETIME NOT NULL,
+    `used_at` TIMESTAMP NOT NULL,
+    PRIMARY KEY (`chat_id`, `message_id`),
+    INDEX (`used_at`)
+);
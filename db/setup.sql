@@ -22,6 +22,7 @@ CREATE TABLE `users` (
     `birth` CHAR(10),
     `show_timestamps` BOOLEAN NOT NULL DEFAULT FALSE,
     `show_extended_info` BOOLEAN NOT NULL DEFAULT FALSE,
+    `ej_fingerprint` CHAR(32),
     FOREIGN KEY (`rasp_entity`) REFERENCES `rasp_entities` (`id`),
     FOREIGN KEY (`sub_entity`) REFERENCES `rasp_entities` (`id`),
     FOREIGN KEY (`ej_group`) REFERENCES `ej_groups` (`id`)
@@ -30,11 +31,13 @@ CREATE TABLE `users` (
 CREATE TABLE ej_marks (
     `id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
     `chat_id` VARCHAR(20) NOT NULL,
+    `hash` CHAR(32) NOT NULL,
     `mark` VARCHAR(20) NOT NULL,
     `name` VARCHAR(20) NOT NULL,
     `month` VARCHAR(2) NOT NULL,
-    `dat` VARCHAR(2) NOT NULL,
+    `day` VARCHAR(2) NOT NULL,
     `title` VARCHAR(100),
+    UNIQUE (`chat_id`, `hash`),
     FOREIGN KEY (`chat_id`) REFERENCES `users` (`chat_id`)
 );
 
@@ -45,3 +48,21 @@ CREATE TABLE ej_average_data (
     `mark` VARCHAR(3) NOT NULL,
     FOREIGN KEY (`chat_id`) REFERENCES `users` (`chat_id`)
 );
+
+CREATE TABLE `rasp_messages` (
+    `chat_id` VARCHAR(20) NOT NULL,
+    `message_id` INT UNSIGNED NOT NULL,
+    `type` ENUM('group', 'teacher', 'place', 'subject') NOT NULL,
+    `entity_id` INT UNSIGNED NOT NULL,
+    `date` DATETIME NOT NULL,
+    `used_at` TIMESTAMP NOT NULL,
+    PRIMARY KEY (`chat_id`, `message_id`),
+    INDEX (`used_at`)
+);
+
+CREATE TABLE `state` (
+    `namespace` VARCHAR(32) NOT NULL,
+    `key` VARCHAR(64) NOT NULL,
+    `value` TEXT NOT NULL,
+    PRIMARY KEY (`namespace`, `key`)
+);
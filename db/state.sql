@@ -0,0 +1,6 @@
+CREATE TABLE `state` (
+    `namespace` VARCHAR(32) NOT NULL,
+    `key` VARCHAR(64) NOT NULL,
+    `value` TEXT NOT NULL,
+    PRIMARY KEY (`namespace`, `key`)
+);
@@ -9,6 +9,7 @@ CREATE TABLE `users` (
     `birth` CHAR(10),
     `show_timestamps` BOOLEAN NOT NULL DEFAULT FALSE,
     `show_extended_info` BOOLEAN NOT NULL DEFAULT FALSE,
+    `ej_fingerprint` CHAR(32),
     FOREIGN KEY (`rasp_entity`) REFERENCES `rasp_entities` (`id`),
     FOREIGN KEY (`sub_entity`) REFERENCES `rasp_entities` (`id`),
     FOREIGN KEY (`ej_group`) REFERENCES `ej_groups` (`id`)
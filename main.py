@@ -1,6 +1,17 @@
+import time
+started = time.perf_counter()
+
+import asyncio
 import logging
-from modules.client import client, scheduler
-import modules.commands
+from contextlib import contextmanager
+from modules.client import client, start_client
+from modules.leader import scheduler_leader
+from modules.fetch import fetcher
+from modules.parsing import parse_service
+from modules.db_utils import pool, load_rasp_entities
+from modules.commands import load_bot_username
+from modules.commands.rasp import refresh_rasp_entities, watch_rasp_entities, rasp_messages
+from modules.commands.ej import kbp_ej
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(message)s',
@@ -8,6 +19,45 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S %Z'
 )
 
+phases = {'import': time.perf_counter() - started}
+
+@contextmanager
+def phase(name: str):
+    phase_started = time.perf_counter()
+    yield
+    phases[name] = time.perf_counter() - phase_started
+
+background: set[asyncio.Task] = set()
+
+async def startup():
+    with phase('telegram'):
+        await start_client()
+    with phase('mysql'):
+        pool.get_connection().close()
+    with phase('entities'):
+        load_rasp_entities()
+    with phase('rasp_messages'):
+        rasp_messages.load()
+    with phase('get_me'):
+        await load_bot_username()
+    with phase('scheduler'):
+        await scheduler_leader.start()
+    # kbp.by may be slow or down, the bot answers with the entities it already has meanwhile.
+    # with several processes only the scheduler leader writes them, its daily job keeps them fresh after that
+    # and every process reloads them when their version changes
+    tasks = [watch_rasp_entities()]
+    if scheduler_leader.leader:
+        tasks.append(refresh_rasp_entities())
+    for coroutine in tasks:
+        task = asyncio.create_task(coroutine)
+        background.add(task)
+        task.add_done_callback(background.discard)
+    logging.info('startup: %s, total %.2fs', ', '.join('{} {:.2f}s'.format(name, seconds) for name, seconds in phases.items()), time.perf_counter() - started)
+
 if __name__ == '__main__':
-    scheduler.start()
+    client.loop.run_until_complete(startup())
     client.run_until_disconnected()
+    scheduler_leader.stop()
+    client.loop.run_until_complete(kbp_ej.close())
+    client.loop.run_until_complete(fetcher.close())
+    parse_service.shutdown()
@@ -0,0 +1,46 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from .config import EJ_CAPTURE_DIR, EJ_CAPTURE_FILES, EJ_CAPTURE_SIZE
+
+class PageCapture:
+    def __init__(self, directory: str, files: int, max_size: int):
+        self.directory = directory
+        self.files = files
+        self.max_size = max_size
+        self.__writes: set[asyncio.Future] = set()
+        self.__lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory != '' and self.files > 0
+
+    def __path(self, key: str, index: int) -> str:
+        return os.path.join(self.directory, '{}.{}.html'.format(key, index) if index > 0 else '{}.html'.format(key))
+
+    def write(self, key: str, content: bytes):
+        with self.__lock:
+            os.makedirs(self.directory, exist_ok=True)
+            for i in range(self.files - 1, 0, -1):
+                if os.path.exists(self.__path(key, i - 1)):
+                    os.replace(self.__path(key, i - 1), self.__path(key, i))
+            with open(self.__path(key, 0), 'wb') as f:
+                f.write(content[:self.max_size])
+
+    def capture(self, user: str, content: bytes):
+        if not self.enabled:
+            return
+        # file names must not contain the credentials the page was fetched with
+        key = hashlib.blake2b(user.encode(), digest_size=8).hexdigest()
+        write = asyncio.get_running_loop().run_in_executor(None, self.write, key, content)
+        self.__writes.add(write)
+        write.add_done_callback(self.__done)
+
+    def __done(self, write: asyncio.Future):
+        self.__writes.discard(write)
+        if not write.cancelled() and write.exception() is not None:
+            logging.error(write.exception(), exc_info=write.exception())
+
+ej_capture = PageCapture(EJ_CAPTURE_DIR, EJ_CAPTURE_FILES, EJ_CAPTURE_SIZE)
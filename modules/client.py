@@ -1,9 +1,12 @@
 from telethon import TelegramClient
-from .config import TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_BOT_TOKEN, MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE
+from .config import TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_BOT_TOKEN, TELEGRAM_SESSION, MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from pytz import timezone
 
-client = TelegramClient('sessions/bot', TELEGRAM_API_ID, TELEGRAM_API_HASH).start(bot_token=TELEGRAM_BOT_TOKEN)
+client = TelegramClient('sessions/{}'.format(TELEGRAM_SESSION), TELEGRAM_API_ID, TELEGRAM_API_HASH)
+
+async def start_client():
+    await client.start(bot_token=TELEGRAM_BOT_TOKEN)
 
 scheduler = AsyncIOScheduler(timezone=timezone('Europe/Minsk'), jobstores={'default': SQLAlchemyJobStore(url='mysql+mysqlconnector://{}:{}@{}/{}'.format(MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST, MYSQL_DATABASE))})
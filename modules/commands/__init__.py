@@ -1,17 +1,43 @@
 from enum import Enum
-from ..client import client
+from ..client import client, scheduler
 from ..config import MESSAGES
-from telethon import events, Button
+from ..state import StateMap, SQLStateBackend, state_backend
+from telethon import events, Button, types, utils
 from functools import wraps
+from typing import Callable
 import logging
+import asyncio
+import time
+import re
 
 def common_translit(text: str) -> str:
     return text.replace('t', 'т').replace('T', 'Т').replace('k', 'к').replace('K', 'К')
 
-bot_username = client.loop.run_until_complete(client.get_me()).username
+bot_username: str | None = None
 
-def command(command: str, parameters: int = 0, exact: bool = False) -> str:
-    return r'^/{}(?>@{})?{}$'.format(command, bot_username, r'(?> (\S+)){}'.format('?' if not exact else '') * parameters)
+async def load_bot_username():
+    global bot_username
+    bot_username = (await client.get_me()).username
+
+class CommandPattern:
+    # handlers are registered at import, before the bot knows its username, so the pattern is compiled on first use
+    def __init__(self, command: str, parameters: int = 0, exact: bool = False):
+        self.__source = r'^/{}(?>@{{}})?{}$'.format(command, r'(?> (\S+)){}'.format('?' if not exact else '') * parameters)
+        self.__pattern: re.Pattern | None = None
+
+    def __call__(self, text: str) -> re.Match | None:
+        if self.__pattern is None:
+            if bot_username is None:
+                return re.match(self.__source.format(r'\w+'), text)
+            self.__pattern = re.compile(self.__source.format(bot_username))
+        return self.__pattern.match(text)
+
+commands: list[CommandPattern] = []
+
+def command(command: str, parameters: int = 0, exact: bool = False) -> CommandPattern:
+    pattern = CommandPattern(command, parameters, exact)
+    commands.append(pattern)
+    return pattern
 
 def error_handler(func):
     @wraps(func)
@@ -25,6 +51,39 @@ def error_handler(func):
             await client.send_message(event.chat_id, MESSAGES['error'], parse_mode='md')
     return wrapper
 
+def update_key(update: types.TypeUpdate) -> str | None:
+    match update:
+        case types.UpdateBotCallbackQuery():
+            return 'callback:{}'.format(update.query_id)
+        case types.UpdateNewMessage() | types.UpdateNewChannelMessage() if update.message.peer_id is not None:
+            return 'message:{}:{}'.format(utils.get_peer_id(update.message.peer_id), update.message.id)
+        case types.UpdateShortMessage():
+            return 'message:{}:{}'.format(update.user_id, update.id)
+        case types.UpdateShortChatMessage():
+            return 'message:{}:{}'.format(utils.get_peer_id(types.PeerChat(update.chat_id)), update.id)
+    return None
+
+if isinstance(state_backend, SQLStateBackend):
+    # several workers, each with its own session, may all receive an update. registered before every other handler,
+    # so the worker that claims it first handles it and the rest stop here
+    @client.on(events.Raw())
+    async def claim_update(update: types.TypeUpdate):
+        key = update_key(update)
+        if key is None:
+            return
+        try:
+            claimed = await asyncio.get_running_loop().run_in_executor(None, state_backend.claim, 'updates', key)
+        except Exception as e:
+            # handling it twice is better than not at all
+            logging.warning('update claim failed: %s', repr(e))
+            return
+        if not claimed:
+            raise events.StopPropagation
+
+    @scheduler.scheduled_job('interval', hours=1, id='prune_updates', misfire_grace_time=3600)
+    async def prune_updates():
+        await asyncio.get_running_loop().run_in_executor(None, state_backend.prune, 'updates', int(time.time()) - 24 * 60 * 60)
+
 class Action(Enum):
     FEEDBACK = 'feedback'
     SEND = 'send'
@@ -32,12 +91,19 @@ class Action(Enum):
     EJ_GROUP = 'ej_group'
     EJ_BIRTHDAY = 'ej_birthday'
 
-actions: dict[int, Action] = {}
+actions = StateMap('actions', encode=lambda action: action.value, decode=Action)
+dialogs: dict[Action, Callable] = {}
+
+def dialog(*dialog_actions: Action):
+    def decorator(func):
+        for action in dialog_actions:
+            dialogs[action] = func
+        return func
+    return decorator
 
 async def cancel(chat_id: int):
-    if chat_id in actions:
+    if await actions.pop(chat_id, None) is not None:
         await client.send_message(chat_id, MESSAGES['cancel'], parse_mode='md')
-        actions.pop(chat_id)
 
 cancel_button = Button.inline(MESSAGES['buttons']['cancel'], data='cancel')
 
@@ -51,3 +117,14 @@ async def cancel_command(event: events.NewMessage.Event):
     await cancel(event.chat_id)
 
 from . import general, rasp, admin, ej
+
+# registered after every command. a command typed in the middle of a dialog runs on its own and is not taken as the answer.
+# one handler for all dialogs, so a message costs one state lookup
+@client.on(events.NewMessage())
+@error_handler
+async def dialog_message(event: events.NewMessage.Event):
+    if any(pattern(event.raw_text) for pattern in commands):
+        return
+    action = await actions.get(event.chat_id)
+    if action is not None:
+        await dialogs[action](event, action)
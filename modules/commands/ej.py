@@ -1,12 +1,17 @@
-from . import command, Action, actions, cancel_button, cancel, common_translit, error_handler
+from . import command, Action, actions, cancel_button, cancel, common_translit, error_handler, dialog
 from telethon import events, Button
-from ..db_utils import User, get_ej_group_id, get_ej_group_name, add_marks, get_marks, with_user, Status, get_average_data, replace_average_data, get_ej_subs, Mark
+from ..db_utils import User, get_ej_group_id, get_ej_group_name, with_user, Status, get_average_data, replace_average_data, get_ej_subs, Mark, add_new_marks, update_ej_fingerprints
 from ..client import client, scheduler
-from ..config import MESSAGES
+from ..config import MESSAGES, EJ_CONCURRENCY
+from ..dispatcher import dispatcher, Delivery
 from ..kbp import Journal
+from ..state import StateMap
 from re import fullmatch
 from itertools import zip_longest
 import logging
+import asyncio
+import time
+from functools import partial
 from ..utils import MessagePane, MessagePaneDirection, TextMessageContent, MessageContentConstraint, MessageModifierFlag
 
 kbp_ej = Journal()
@@ -19,12 +24,12 @@ def users_only(func):
     return wrapper
 
 async def check_ej(user: User, surname: str, group: str, birth: str) -> list[Mark]:
-    marks = kbp_ej.get_ej(surname, group, birth)
-    if marks is None:
+    journal = await kbp_ej.get_new_ej(surname, group, birth, None)
+    if journal is None:
         raise ValueError('Invalid ej data')
-    old_marks = get_marks(user)
-    new_marks = list(set(marks).difference(old_marks))
-    add_marks(user, new_marks)
+    fingerprint, marks = journal
+    new_marks = add_new_marks({user: marks})[user.chat_id]
+    user.ej_fingerprint = fingerprint
     return new_marks
 
 yes_no_ej_buttons = [
@@ -67,66 +72,59 @@ async def ej(event: events.NewMessage.Event, user: User):
         return
     await client.send_message(event.chat_id, MESSAGES['ej']['privacy'], buttons=yes_no_ej_buttons)
 
-ej_data_buffer: dict[int, dict[str, str]] = {}
+ej_data_buffer = StateMap('ej_data')
 
 @client.on(events.CallbackQuery(data='ej_data_yes'))
 @error_handler
 async def ej_yes(event: events.CallbackQuery.Event):
     await event.answer()
-    actions[event.chat_id] = Action.EJ_SURNAME
+    await actions.set(event.chat_id, Action.EJ_SURNAME)
     await client.edit_message(event.chat_id, event.message_id, MESSAGES['ej']['enter_data'], buttons=cancel_button)
     await client.send_message(event.chat_id, MESSAGES['ej']['enter_surname'])
-    ej_data_buffer[event.chat_id] = {}
+    await ej_data_buffer.set(event.chat_id, {})
 
 @client.on(events.CallbackQuery(data='ej_data_no'))
 @error_handler
 async def ej_no(event: events.CallbackQuery.Event):
     await event.answer()
-    if event.chat_id in actions:
-        actions.pop(event.chat_id)
+    await actions.pop(event.chat_id, None)
     await client.edit_message(event.chat_id, event.message_id, MESSAGES['cancel'])
 
-@client.on(events.NewMessage())
-@error_handler
-async def new_message(event: events.NewMessage.Event):
-    if event.chat_id in actions:
-        action = actions[event.chat_id]
-        match action:
-            case Action.EJ_SURNAME:
-                ej_data_buffer[event.chat_id]['surname'] = event.message.text
-                await client.send_message(event.chat_id, MESSAGES['ej']['enter_group'])
-                actions[event.chat_id] = Action.EJ_GROUP
-            case Action.EJ_GROUP:
+@dialog(Action.EJ_SURNAME, Action.EJ_GROUP, Action.EJ_BIRTHDAY)
+async def ej_data_message(event: events.NewMessage.Event, action: Action):
+    match action:
+        case Action.EJ_SURNAME:
+            # StateMap hands out copies, so the buffer is written back as a whole
+            await ej_data_buffer.set(event.chat_id, await ej_data_buffer.get(event.chat_id, {}) | {'surname': event.message.text})
+            await client.send_message(event.chat_id, MESSAGES['ej']['enter_group'])
+            await actions.set(event.chat_id, Action.EJ_GROUP)
+        case Action.EJ_GROUP:
+            try:
+                group = common_translit(event.message.text)
+                group = get_ej_group_id(group)
+                await ej_data_buffer.set(event.chat_id, await ej_data_buffer.get(event.chat_id, {}) | {'group': group})
+                await client.send_message(event.chat_id, MESSAGES['ej']['enter_birth'])
+                await actions.set(event.chat_id, Action.EJ_BIRTHDAY)
+            except NameError:
+                await client.send_message(event.chat_id, MESSAGES['ej']['group_invalid'])
+        case Action.EJ_BIRTHDAY:
+            birth = event.message.text.replace('-', '.').replace('/', '.')
+            if not fullmatch('[0-3][0-9].[0-1][0-9].[1-2][09][06-9][0-9]', birth):
+                await client.send_message(event.chat_id, MESSAGES['ej']['birth_invalid'])
+            else:
+                await ej_data_buffer.set(event.chat_id, await ej_data_buffer.get(event.chat_id, {}) | {'birth': birth})
+                message = await client.send_message(event.chat_id, MESSAGES['ej']['checking'])
                 try:
-                    group = common_translit(event.message.text)
-                    group = get_ej_group_id(group)
-                    ej_data_buffer[event.chat_id]['group'] = group
-                    await client.send_message(event.chat_id, MESSAGES['ej']['enter_birth'])
-                    actions[event.chat_id] = Action.EJ_BIRTHDAY
-                except NameError:
-                    await client.send_message(event.chat_id, MESSAGES['ej']['group_invalid'])
-            case Action.EJ_BIRTHDAY:
-                birth = event.message.text.replace('-', '.').replace('/', '.')
-                if not fullmatch('[0-3][0-9].[0-1][0-9].[1-2][09][06-9][0-9]', birth):
-                    await client.send_message(event.chat_id, MESSAGES['ej']['birth_invalid'])
-                else:
-                    ej_data_buffer[event.chat_id]['birth'] = birth
-                    message = await client.send_message(event.chat_id, MESSAGES['ej']['checking'])
-                    try:
-                        actions.pop(event.chat_id)
-                        ej_data = ej_data_buffer.pop(event.chat_id)
-                        user = User(event.chat_id)
+                    await actions.pop(event.chat_id)
+                    ej_data = await ej_data_buffer.pop(event.chat_id)
+                    with User(event.chat_id) as user:
                         await check_ej(user, ej_data['surname'], ej_data['group'], ej_data['birth'])
                         user.surname = ej_data['surname']
                         user.ej_group = ej_data['group']
                         user.birth = ej_data['birth']
-                        await message.edit(MESSAGES['ej']['data_saved'])
-                    except ValueError:
-                        await message.edit(MESSAGES['ej']['invalid'])
-            case _:
-                return
-
-        raise events.StopPropagation
+                    await message.edit(MESSAGES['ej']['data_saved'])
+                except ValueError:
+                    await message.edit(MESSAGES['ej']['invalid'])
 
 @client.on(events.NewMessage(pattern=command("del_ej")))
 @error_handler
@@ -147,6 +145,7 @@ async def del_ej_yes(event: events.CallbackQuery.Event, user: User):
     user.ej_group = None
     user.birth = None
     user.ej_sub = False
+    user.ej_fingerprint = None
     await client.edit_message(event.chat_id, event.message_id, MESSAGES['del_ej']['success'])
 
 @client.on(events.CallbackQuery(data='del_ej_data_no'))
@@ -193,10 +192,7 @@ def format_average(marks: list[Mark], extended_info: bool = False, average_data:
             mark_text += warning
         mark_pane.add(TextMessageContent(mark_text, MessageContentConstraint.FILL))
         message.add(mark_pane)
-    text = ''
-    for line in message.render().split('\n'):
-        text += line.rstrip('⠀') + '\n'
-    return text
+    return message.render(trim='⠀') + '\n'
 
 @client.on(events.NewMessage(pattern=command("average")))
 @error_handler
@@ -208,7 +204,7 @@ async def average(event: events.NewMessage.Event, user: User):
         await client.send_message(event.chat_id, MESSAGES['average']['no_data'])
         return
     message = await client.send_message(event.chat_id, MESSAGES['average']['pending'])
-    average = kbp_ej.get_average(login_data['surname'], login_data['group'], login_data['birth'])
+    average = await kbp_ej.get_average(login_data['surname'], login_data['group'], login_data['birth'])
     text = format_average(average, user.show_extended_info, get_average_data(user))
     await message.edit(text)
     replace_average_data(user, average)
@@ -238,16 +234,44 @@ async def unsub_ej(event: events.NewMessage.Event, user: User):
     user.ej_sub = False
     await client.send_message(event.chat_id, MESSAGES['unsub_ej']['success'])
 
+ej_sessions = asyncio.Semaphore(EJ_CONCURRENCY)
+
+async def fetch_ej(user: User) -> tuple[str, list[Mark] | None] | None:
+    async with ej_sessions:
+        return await kbp_ej.get_new_ej(user.surname, user.ej_group, user.birth, user.ej_fingerprint)
+
 @scheduler.scheduled_job('cron', hour=13, minute=50, id='send_ej', misfire_grace_time=3600)
 async def send_ej():
+    started = time.monotonic()
     subs = get_ej_subs()
-    for sub in subs:
-        try:
-            message = await client.send_message(sub.chat_id, MESSAGES['ej']['pending'])
-            marks = await check_ej(sub, sub.surname, sub.ej_group, sub.birth)
-            if len(marks) == 0:
-                await message.edit(MESSAGES['ej']['no_marks'])
-                continue
-            await message.edit(format_marks(marks))
-        except Exception as e:
-            logging.error(e, exc_info=True)
+    results = await asyncio.gather(*(fetch_ej(sub) for sub in subs), return_exceptions=True)
+    fetched = time.monotonic()
+
+    journals: dict[User, list[Mark]] = {}
+    fingerprints: dict[int, str] = {}
+    new_marks: dict[User, list[Mark]] = {}
+    for sub, result in zip(subs, results):
+        if isinstance(result, Exception):
+            logging.error(result, exc_info=result)
+        elif result is None:
+            logging.warning('send_ej: invalid ej data for chat %d', sub.chat_id)
+        elif result[1] is None:
+            new_marks[sub] = []
+        else:
+            fingerprints[sub.chat_id], journals[sub] = result
+
+    added = add_new_marks(journals)
+    new_marks.update((sub, added[sub.chat_id]) for sub in journals)
+    # only after the marks are stored, otherwise a failed run would hide them from the next one
+    update_ej_fingerprints(fingerprints)
+    stored = time.monotonic()
+    unchanged = len(new_marks) - len(journals)
+    logging.info('send_ej: %d of %d journals unchanged (%.0f%%), parsing and diffing skipped', unchanged, len(new_marks), unchanged / len(new_marks) * 100 if len(new_marks) > 0 else 0)
+
+    deliveries = [
+        Delivery(sub.chat_id, partial(client.send_message, sub.chat_id, format_marks(marks) if len(marks) > 0 else MESSAGES['ej']['no_marks']))
+        for sub, marks in new_marks.items()
+    ]
+    stats = await dispatcher.run('send_ej', deliveries)
+    logging.info('send_ej: %d subscribers, %d journals fetched and parsed in %.2fs, %d new marks diffed and stored in %.2fs, sent in %.2fs, total %.2fs',
+        len(subs), len(journals), fetched - started, sum(len(marks) for marks in new_marks.values()), stored - fetched, stats.finished - stats.started, time.monotonic() - started)
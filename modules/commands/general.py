@@ -2,7 +2,8 @@ from telethon import events, Button
 from ..config import MESSAGES, FEEDBACK_CHANNEL_ID
 from ..db_utils import with_user, User, Status
 from ..client import client
-from . import Action, actions, command, cancel_button, cancel, error_handler
+from ..state import StateMap
+from . import Action, actions, command, cancel_button, cancel, error_handler, dialog
 
 @client.on(events.NewMessage(pattern=command('start')))
 @error_handler
@@ -105,22 +106,13 @@ yes_no_buttons = client.build_reply_markup([
     [Button.inline(MESSAGES['buttons']['no'], data='feedback_no')]
 ])
 
-feedback_buffer: dict[int, str] = {}
+feedback_buffer = StateMap('feedback')
 
-@client.on(events.NewMessage())
-@error_handler
-async def new_message(event: events.NewMessage.Event):
-    if event.chat_id in actions:
-        action = actions[event.chat_id]
-        match action:
-            case Action.FEEDBACK:
-                feedback_buffer[event.chat_id] = event.message.text
-                await client.send_message(event.chat_id, MESSAGES['feedback']['sure'], buttons=yes_no_buttons, parse_mode='md')
-                actions.pop(event.chat_id)
-            case _:
-                return
-
-        raise events.StopPropagation
+@dialog(Action.FEEDBACK)
+async def feedback_message(event: events.NewMessage.Event, action: Action):
+    await feedback_buffer.set(event.chat_id, event.message.text)
+    await client.send_message(event.chat_id, MESSAGES['feedback']['sure'], buttons=yes_no_buttons, parse_mode='md')
+    await actions.pop(event.chat_id)
 
 @client.on(events.NewMessage(pattern=command('feedback')))
 @error_handler
@@ -130,7 +122,7 @@ async def feedback(event: events.NewMessage.Event, user: User):
         await client.send_message(event.chat_id, MESSAGES['placeholder'], parse_mode='md')
         return
     await client.send_message(event.chat_id, MESSAGES['feedback']['init'], buttons=cancel_button, parse_mode='md')
-    actions[event.chat_id] = Action.FEEDBACK
+    await actions.set(event.chat_id, Action.FEEDBACK)
     raise events.StopPropagation
 
 @client.on(events.CallbackQuery(data='feedback_yes'))
@@ -138,7 +130,7 @@ async def feedback(event: events.NewMessage.Event, user: User):
 async def yes(event: events.CallbackQuery.Event):
     await event.answer()
     await client.edit_message(event.chat_id, event.message_id, MESSAGES['feedback']['thanks'], parse_mode='md')
-    feedback_message = feedback_buffer.pop(event.chat_id)
+    feedback_message = await feedback_buffer.pop(event.chat_id)
     user = '@{}'.format(event.sender.username) if event.sender.username else '[{}](tg://user?id={})'.format(event.sender.first_name, event.sender.id)
     await client.send_message(FEEDBACK_CHANNEL_ID, '{}\n\n{}'.format(feedback_message, user))
 
@@ -146,6 +138,5 @@ async def yes(event: events.CallbackQuery.Event):
 @error_handler
 async def no(event: events.CallbackQuery.Event):
     await event.answer()
-    if event.chat_id in feedback_buffer:
-        feedback_buffer.pop(event.chat_id)
+    await feedback_buffer.pop(event.chat_id, None)
     await client.edit_message(event.chat_id, event.message_id, MESSAGES['cancel'], parse_mode='md')
@@ -1,20 +1,60 @@
 from telethon import events, Button
 from telethon.types import ReplyKeyboardMarkup
 from telethon.errors import MessageNotModifiedError
-from ..config import MESSAGES
-from ..db_utils import with_user, User, get_subs, get_rasp_entity, find_rasp_entity, RaspEntity, RaspEntityType, update_rasp_entities
+from ..config import MESSAGES, RASP_MESSAGES_SIZE, RASP_MESSAGES_TTL
+from ..db_utils import with_user, User, get_subs, get_rasp_entity, find_rasp_entity, RaspEntity, RaspEntityType, rasp_entity_index, update_rasp_entities, load_rasp_entities, get_rasp_message, get_recent_rasp_messages
 from ..client import client, scheduler
-from ..kbp import Rasp, Weekday, PairType
+from ..dispatcher import dispatcher, Delivery
+from ..kbp import Rasp, Weekday, PairType, Timetable
 from . import command, common_translit, error_handler
 import logging
-from datetime import datetime, timezone, timedelta
-from ..utils import MessagePane, MessagePaneDirection, TextMessageContent, MessageContentConstraint, MessageModifierFlag
+import asyncio
+import time
+import re
+import struct
+from enum import Enum
+from dataclasses import dataclass
+from datetime import datetime, date, timezone, timedelta
+from ..state import StateMap
+from ..utils import MessagePane, MessagePaneDirection, TextMessageContent, MessageContentConstraint, MessageModifierFlag, TTLCache, CacheState
 from itertools import zip_longest
-from functools import wraps
+from functools import wraps, partial
 
 tz = timezone(timedelta(hours=3))
 kbp_rasp = Rasp()
-update_rasp_entities(kbp_rasp.get_rasp_list())
+
+# bumped when the entity table changes, so every process reloads its index and not only the one that synced it
+rasp_entities_version = StateMap('rasp_entities')
+loaded_entities_version = 0
+
+@scheduler.scheduled_job('cron', hour=6, minute=30, id='refresh_rasp_entities', misfire_grace_time=3600)
+async def refresh_rasp_entities():
+    global loaded_entities_version
+    try:
+        started = time.monotonic()
+        entities = await kbp_rasp.get_rasp_list()
+        logging.info('refresh_rasp_entities: %d entities downloaded in %.2fs', len(entities), time.monotonic() - started)
+        loop = asyncio.get_running_loop()
+        # the sync is a blocking transaction, keep it off the loop that serves users
+        if await loop.run_in_executor(None, update_rasp_entities, entities) > 0:
+            loaded_entities_version = await rasp_entities_version.get('version', 0) + 1
+            await rasp_entities_version.set('version', loaded_entities_version)
+    except Exception as e:
+        logging.error(e, exc_info=True)
+
+async def watch_rasp_entities(interval: float = 60):
+    global loaded_entities_version
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            version = await rasp_entities_version.get('version', 0)
+            if version != loaded_entities_version:
+                await loop.run_in_executor(None, load_rasp_entities)
+                loaded_entities_version = version
+                logging.info('rasp entities reloaded, version %d', version)
+        except Exception as e:
+            logging.error(e, exc_info=True)
 
 def format_rasp(weekday: Weekday, entity: RaspEntity, width: int, show_timestamps: bool = False) -> MessagePane:
     pane = MessagePane(MessagePaneDirection.VERTICAL)
@@ -35,7 +75,8 @@ def format_rasp(weekday: Weekday, entity: RaspEntity, width: int, show_timestamp
             pair_pane.add(TextMessageContent('[{}]⠀{}|⠀'.format(pair.time, '⠀' * (5 - len(pair.time)))))
         pair_pane.add(TextMessageContent('{}⠀'.format(pair.number) + ('⠀' if len(str(pair.number)) == 1 else '')))
 
-        name = pair.names.pop() if len(pair.names) > 0 else ''
+        name = pair.names[-1] if len(pair.names) > 0 else ''
+        names, places, teachers, groups = pair.names[:-1], pair.places[:-1], pair.teachers, pair.groups
         modifiers = MessageModifierFlag.NONE
         match pair.type:
             case PairType.ADDED:
@@ -46,43 +87,40 @@ def format_rasp(weekday: Weekday, entity: RaspEntity, width: int, show_timestamp
                 modifiers = MessageModifierFlag.STRIKETHROUGH
         pair_pane.add(TextMessageContent(name, MessageContentConstraint.FILL, modifiers))
         if len(pair.places) > 0:
-            pair_pane.add(TextMessageContent('⠀[{}]'.format(pair.places.pop())))
+            pair_pane.add(TextMessageContent('⠀[{}]'.format(pair.places[-1])))
         else:
             pair_pane.add(TextMessageContent('⠀' * 7))
         pane.add(pair_pane)
 
         match entity.type:
             case RaspEntityType.TEACHER:
-                if len(pair.groups) > 0:
+                if len(groups) > 0:
                     pair_pane = MessagePane(MessagePaneDirection.HORIZONTAL, size=width)
                     if not show_timestamps:
                         pair_pane.add(TextMessageContent('⠀' * 7))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
-                    pair_pane.add(TextMessageContent(pair.groups.pop(), MessageContentConstraint.FILL))
+                    pair_pane.add(TextMessageContent(groups[-1], MessageContentConstraint.FILL))
                     pane.add(pair_pane)
-                if len(pair.teachers) > 0:
-                    pair.teachers.pop()
+                teachers, groups = teachers[:-1], groups[:-1]
             case RaspEntityType.SUBJECT | RaspEntityType.PLACE:
-                if len(pair.teachers) > 0 and len(pair.groups) > 0:
+                if len(teachers) > 0 and len(groups) > 0:
                     pair_pane = MessagePane(MessagePaneDirection.HORIZONTAL, size=width)
                     if show_timestamps:
                         pair_pane.add(TextMessageContent('⠀' * 5))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
                     pair_pane.add(TextMessageContent('', MessageContentConstraint.FILL))
-                    pair_pane.add(TextMessageContent(pair.teachers.pop(), MessageContentConstraint.FILL))
+                    pair_pane.add(TextMessageContent(teachers[-1], MessageContentConstraint.FILL))
                     pair_pane.add(TextMessageContent('⠀', MessageContentConstraint.FILL))
-                    pair_pane.add(TextMessageContent(pair.groups.pop(), MessageContentConstraint.FILL))
+                    pair_pane.add(TextMessageContent(groups[-1], MessageContentConstraint.FILL))
                     pane.add(pair_pane)
+                    teachers, groups = teachers[:-1], groups[:-1]
             case RaspEntityType.GROUP:
-                if len(pair.teachers) > 0:
-                    pair.teachers.pop()
-                if len(pair.groups) > 0:
-                    pair.groups.pop()
+                teachers, groups = teachers[:-1], groups[:-1]
 
-        for name, place, teacher, group in zip_longest(pair.names, pair.places, pair.teachers, pair.groups, fillvalue=''):
+        for name, place, teacher, group in zip_longest(names, places, teachers, groups, fillvalue=''):
             pair_pane = MessagePane(MessagePaneDirection.HORIZONTAL, size=width)
             if show_timestamps:
                 pair_pane.add(TextMessageContent('⠀' * 4))
@@ -122,28 +160,79 @@ def format_rasp(weekday: Weekday, entity: RaspEntity, width: int, show_timestamp
     
     return pane
         
-def get_date_rasp(rasp: dict[str, list[Weekday]], entity: RaspEntity, date: datetime, show_timestamps: bool = False) -> str:
-    width = 32 if show_timestamps else 24
+rendered_rasp = TTLCache('rendered_rasp', maxsize=1024, ttl=24 * 60 * 60)
+
+def get_date_rasp(rasp: Timetable, entity: RaspEntity, date: datetime, show_timestamps: bool = False) -> str:
     today = datetime.now(tz)
     week = 'left'
     delta = (today - date).days
     if delta < today.weekday() - 5:
         week = 'right'
+    # the timetable version changes with its content, so new substitutions never hit an old text
+    key = (entity, date.date(), week, show_timestamps, rasp.version)
+    state, text = rendered_rasp.lookup(key)
+    if state is not CacheState.FRESH:
+        text = render_date_rasp(rasp, entity, date, week, show_timestamps)
+        rendered_rasp.set(key, text)
+    if (rendered_rasp.hits + rendered_rasp.misses) % 500 == 0:
+        logging.info('rendered_rasp cache: %s, hit rate %.0f%%', rendered_rasp.stats(), rendered_rasp.hits / (rendered_rasp.hits + rendered_rasp.misses) * 100)
+    return text
+
+def render_date_rasp(rasp: Timetable, entity: RaspEntity, date: datetime, week: str, show_timestamps: bool) -> str:
+    width = 32 if show_timestamps else 24
     datestr = '{}.{}'.format(('0' if len(str(date.day)) == 1 else '') + str(date.day), ('0' if len(str(date.month)) == 1 else '') + str(date.month))
     message = format_rasp(rasp[week][date.weekday()], entity, width, show_timestamps)
     date_pane = MessagePane(MessagePaneDirection.HORIZONTAL, size=width)
     date_pane.add(TextMessageContent(datestr, MessageContentConstraint.FILL, MessageModifierFlag.BOLD))
     message.prepend(date_pane)
-    text = ''
-    for line in message.render().split('\n'):
-        text += line.rstrip('⠀') + '\n'
-    return text
+    return message.render(trim='⠀') + '\n'
  
-rasp_buttons: ReplyKeyboardMarkup = client.build_reply_markup([
-    Button.inline(MESSAGES['buttons']['rasp']['prev'], data='rasp[prev]'),
-    Button.inline(MESSAGES['buttons']['rasp']['update'], data='rasp[update]'),
-    Button.inline(MESSAGES['buttons']['rasp']['next'], data='rasp[next]')
-])
+class RaspAction(Enum):
+    UPDATE = 0
+    PREV = 1
+    NEXT = 2
+
+@dataclass(frozen=True, slots=True)
+class RaspPayload:
+    # b'R', schema version, action, entity type, entity id, days since epoch, flags: 11 of the 64 bytes telegram allows
+    prefix = b'R'
+    version = 1
+    layout = struct.Struct('>BBBIHB')
+    epoch = date(2024, 1, 1)
+    types = (RaspEntityType.GROUP, RaspEntityType.TEACHER, RaspEntityType.PLACE, RaspEntityType.SUBJECT)
+    show_timestamps_flag = 1
+
+    action: RaspAction
+    type: RaspEntityType
+    entity_id: int
+    date: date
+    show_timestamps: bool
+
+    def pack(self) -> bytes:
+        flags = self.show_timestamps_flag if self.show_timestamps else 0
+        return self.prefix + self.layout.pack(self.version, self.action.value, self.types.index(self.type), self.entity_id, (self.date - self.epoch).days, flags)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> 'RaspPayload | None':
+        if not data.startswith(cls.prefix) or len(data) != len(cls.prefix) + cls.layout.size:
+            return None
+        version, action, type, entity_id, days, flags = cls.layout.unpack(data[len(cls.prefix):])
+        if version != cls.version or type >= len(cls.types):
+            return None
+        try:
+            action = RaspAction(action)
+        except ValueError:
+            return None
+        return cls(action, cls.types[type], entity_id, cls.epoch + timedelta(days=days), bool(flags & cls.show_timestamps_flag))
+
+def rasp_buttons(rasp_entity: RaspEntity, date: datetime, show_timestamps: bool) -> ReplyKeyboardMarkup:
+    def data(action: RaspAction) -> bytes:
+        return RaspPayload(action, rasp_entity.type, rasp_entity.id, date.date(), show_timestamps).pack()
+    return client.build_reply_markup([
+        Button.inline(MESSAGES['buttons']['rasp']['prev'], data=data(RaspAction.PREV)),
+        Button.inline(MESSAGES['buttons']['rasp']['update'], data=data(RaspAction.UPDATE)),
+        Button.inline(MESSAGES['buttons']['rasp']['next'], data=data(RaspAction.NEXT))
+    ])
 
 class RaspMessage:
     def __init__(self, chat_id: int, message_id: int):
@@ -168,7 +257,41 @@ class RaspMessageData:
         self.rasp_entity = rasp_entity
         self.date = date
 
-__rasp_messages: dict[RaspMessage, RaspMessageData] = {}
+class RaspMessageStore:
+    # buttons carry their state since RaspPayload, nothing is stored anymore.
+    # the messages sent before it are only looked up, the most recently used in memory and the rest in mysql, until they expire
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__messages: dict[RaspMessage, tuple[RaspMessageData, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+    def __entry(self, row: tuple) -> tuple[RaspMessage, RaspMessageData, float] | None:
+        chat_id, message_id, type, entity_id, date, used_at = row
+        try:
+            rasp_entity = get_rasp_entity(id=entity_id, type=RaspEntityType(type))
+        except NameError:
+            return None
+        return RaspMessage(chat_id, message_id), RaspMessageData(rasp_entity, date.replace(tzinfo=tz)), used_at
+
+    async def get(self, message: RaspMessage) -> RaspMessageData | None:
+        entry = self.__messages.get(message)
+        if entry is not None:
+            return entry[0] if time.time() - entry[1] < self.ttl else None
+        row = await asyncio.get_running_loop().run_in_executor(None, get_rasp_message, message.chat_id, message.message_id, self.ttl)
+        entry = self.__entry(row) if row is not None else None
+        return entry[1] if entry is not None else None
+
+    def load(self):
+        for row in get_recent_rasp_messages(self.maxsize, self.ttl):
+            entry = self.__entry(row)
+            if entry is not None:
+                self.__messages[entry[0]] = entry[1:]
+        logging.info('Loaded %d rasp messages', len(self.__messages))
+
+rasp_messages = RaspMessageStore(RASP_MESSAGES_SIZE, RASP_MESSAGES_TTL)
 
 def normalize_date(date: datetime, forward: bool = True) -> datetime:
     today = datetime.now(tz)
@@ -226,8 +349,7 @@ async def rasp_with_params(user: User, rasp_entity_name: str | None):
             return
     message = await client.send_message(user.chat_id, MESSAGES['rasp']['pending'], parse_mode='md')
     today = normalize_date(datetime.now(tz))
-    await client.edit_message(user.chat_id, message, get_date_rasp(kbp_rasp.get_rasp(rasp_entity), rasp_entity, today, user.show_timestamps), parse_mode='md', buttons=rasp_buttons)
-    __rasp_messages[RaspMessage(user.chat_id, message.id)] = RaspMessageData(rasp_entity, today)
+    await client.edit_message(user.chat_id, message, get_date_rasp(await kbp_rasp.get_rasp(rasp_entity), rasp_entity, today, user.show_timestamps), parse_mode='md', buttons=rasp_buttons(rasp_entity, today, user.show_timestamps))
 
 async def set_entity_with_params(user: User, rasp_entity_name: str | None):
     if rasp_entity_name is not None:
@@ -289,21 +411,29 @@ async def unsub(event: events.NewMessage.Event, user: User):
         user.sub_entity = None
         await client.send_message(event.chat_id, MESSAGES['unsub']['success'].format(rasp_entity.type.alias(), rasp_entity.name), parse_mode='md')
 
-async def send_subs():
+async def send_subs(detected: float | None = None):
+    detected = detected or time.monotonic()
     subs = get_subs()
     today = datetime.now(tz)
     tomorrow = normalize_date(today + timedelta(days=1))
-    for rasp_entity, users in subs.items():
-        rasp_without_timestamps = get_date_rasp(kbp_rasp.get_rasp(rasp_entity), rasp_entity, tomorrow, False)
-        rasp_with_timestamps = get_date_rasp(kbp_rasp.get_rasp(rasp_entity), rasp_entity, tomorrow, True)
+    timetables = await asyncio.gather(*(kbp_rasp.get_rasp(rasp_entity) for rasp_entity in subs), return_exceptions=True)
+    fetched = time.monotonic()
+
+    deliveries: list[Delivery] = []
+    for (rasp_entity, users), timetable in zip(subs.items(), timetables):
+        if isinstance(timetable, Exception):
+            logging.error(timetable, exc_info=timetable)
+            continue
+        texts = {show_timestamps: get_date_rasp(timetable, rasp_entity, tomorrow, show_timestamps) for show_timestamps in set(user.show_timestamps for user in users)}
         for user in users:
-            try:
-                if user.show_timestamps:
-                    await client.send_message(user.chat_id, rasp_with_timestamps, parse_mode='md')
-                else:
-                    await client.send_message(user.chat_id, rasp_without_timestamps, parse_mode='md')
-            except Exception as e:
-                logging.error(e, exc_info=True)
+            deliveries.append(Delivery(user.chat_id, partial(client.send_message, user.chat_id, texts[user.show_timestamps], parse_mode='md')))
+    rendered = time.monotonic()
+
+    stats = await dispatcher.run('send_subs', deliveries)
+    first_delivery = '{:.2f}s'.format(stats.started + stats.first_delivery - detected) if stats.first_delivery is not None else '-'
+    last_delivery = '{:.2f}s'.format(stats.started + stats.last_delivery - detected) if stats.last_delivery is not None else '-'
+    logging.info('send_subs: %d entities fetched in %.2fs and rendered in %.2fs, first delivery %s and last delivery %s after detection',
+        len(subs), fetched - detected, rendered - fetched, first_delivery, last_delivery)
 
 @scheduler.scheduled_job('cron', hour=21, minute=0, day_of_week='mon-sat', id='stop_checking_rasp', misfire_grace_time=3600)
 async def stop_checking_rasp():
@@ -313,38 +443,55 @@ async def stop_checking_rasp():
 async def check_rasp():
     today = datetime.now(tz)
     tomorrow = normalize_date(today + timedelta(days=1))
-    if (kbp_rasp.check_rasp(tomorrow.weekday(), left_week=(today.weekday() != 5))):
+    if (await kbp_rasp.check_rasp(tomorrow.weekday(), left_week=(today.weekday() != 5))):
+        detected = time.monotonic()
         await stop_checking_rasp()
-        await send_subs()
+        await kbp_rasp.invalidate_rasp()
+        await send_subs(detected)
 
 @scheduler.scheduled_job('cron', hour=9, minute=0, day_of_week='mon-sat', id='start_checking_rasp', misfire_grace_time=3600)
 async def start_checking_rasp():
     scheduler.add_job(check_rasp, 'interval', minutes=1, id='check_rasp')
     await check_rasp()
 
+async def edit_rasp_message(event: events.CallbackQuery.Event, rasp_entity: RaspEntity, date: datetime, action: RaspAction, show_timestamps: bool):
+    match action:
+        case RaspAction.PREV:
+            date = normalize_date(date - timedelta(days=1), forward=False)
+        case RaspAction.NEXT:
+            date = normalize_date(date + timedelta(days=1), forward=True)
+    text = get_date_rasp(await kbp_rasp.get_rasp(rasp_entity), rasp_entity, date, show_timestamps)
+    try:
+        await client.edit_message(event.chat_id, event.message_id, text, buttons=rasp_buttons(rasp_entity, date, show_timestamps), parse_mode='md')
+    except MessageNotModifiedError as e:
+        return
+
+# everything the press needs is in the button, so it works after restarts and on any worker without touching mysql
+@client.on(events.CallbackQuery(pattern=re.escape(RaspPayload.prefix)))
+@error_handler
+async def rasp_payload_callback(event: events.CallbackQuery.Event):
+    payload = RaspPayload.unpack(event.data)
+    rasp_entity = rasp_entity_index.get_by_id(payload.type, payload.entity_id) if payload is not None else None
+    if rasp_entity is None:
+        await event.answer(MESSAGES['rasp']['data_not_found'], alert=True)
+        return
+    await event.answer()
+    date = datetime(payload.date.year, payload.date.month, payload.date.day, tzinfo=tz)
+    await edit_rasp_message(event, rasp_entity, date, payload.action, payload.show_timestamps)
+
+# buttons sent before RaspPayload, the first press replaces them with stateless ones
 @client.on(events.CallbackQuery(pattern=r'^rasp\[(.*)\]$'))
 @error_handler
 @with_user
 async def rasp_callback(event: events.CallbackQuery.Event, user: User):
-    rasp_message = RaspMessage(event.chat_id, event.message_id)
-    if rasp_message not in __rasp_messages:
+    rasp_data = await rasp_messages.get(RaspMessage(event.chat_id, event.message_id))
+    if rasp_data is None:
         await event.answer(MESSAGES['rasp']['data_not_found'], alert=True)
         return
     else:
         await event.answer()
-    query = event.pattern_match.group(1).decode()
-    rasp_data = __rasp_messages[rasp_message]
-    match query:
-        case 'prev':
-            rasp_data.date = normalize_date(rasp_data.date - timedelta(days=1), forward=False)
-        case 'next':
-            rasp_data.date = normalize_date(rasp_data.date + timedelta(days=1), forward=True)
-    
-    text = get_date_rasp(kbp_rasp.get_rasp(rasp_data.rasp_entity), rasp_data.rasp_entity, rasp_data.date, user.show_timestamps)
-    try:
-        await client.edit_message(event.chat_id, event.message_id, text, buttons=rasp_buttons, parse_mode='md')
-    except MessageNotModifiedError as e:
-        return
+    action = {'prev': RaspAction.PREV, 'next': RaspAction.NEXT}.get(event.pattern_match.group(1).decode(), RaspAction.UPDATE)
+    await edit_rasp_message(event, rasp_data.rasp_entity, rasp_data.date, action, user.show_timestamps)
 
 @client.on(events.CallbackQuery(data='None'))
 async def none_button(event: events.CallbackQuery.Event):
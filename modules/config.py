@@ -2,8 +2,8 @@ from dotenv import load_dotenv
 import os
 import json
 
-def getenv(key: str) -> str:
-    value = os.environ.get(key)
+def getenv(key: str, default: str | None = None) -> str:
+    value = os.environ.get(key, default)
     if value is None:
         raise EnvironmentError('{} environmvet variable is missing'.format(key))
     return value
@@ -13,6 +13,7 @@ load_dotenv()
 TELEGRAM_API_ID = getenv('TELEGRAM_API_ID')
 TELEGRAM_API_HASH = getenv('TELEGRAM_API_HASH')
 TELEGRAM_BOT_TOKEN = getenv('TELEGRAM_BOT_TOKEN')
+TELEGRAM_SESSION = getenv('TELEGRAM_SESSION', 'bot')
 
 FEEDBACK_CHANNEL_ID = int(getenv('FEEDBACK_CHANNEL_ID'))
 
@@ -21,6 +22,29 @@ MYSQL_USER = getenv('MYSQL_USER')
 MYSQL_PASSWORD = getenv('MYSQL_PASSWORD')
 MYSQL_DATABASE = getenv('MYSQL_DATABASE')
 
+HTTP_TIMEOUT = float(getenv('HTTP_TIMEOUT', '15'))
+HTTP_RETRIES = int(getenv('HTTP_RETRIES', '3'))
+KBP_CONCURRENCY = int(getenv('KBP_CONCURRENCY', '8'))
+EJ_CONCURRENCY = int(getenv('EJ_CONCURRENCY', '4'))
+EJ_SESSION_TTL = float(getenv('EJ_SESSION_TTL', '120'))
+
+EJ_CAPTURE_DIR = getenv('EJ_CAPTURE_DIR', '')
+EJ_CAPTURE_FILES = int(getenv('EJ_CAPTURE_FILES', '3'))
+EJ_CAPTURE_SIZE = int(getenv('EJ_CAPTURE_SIZE', str(2 * 1024 * 1024)))
+
+RASP_MESSAGES_SIZE = int(getenv('RASP_MESSAGES_SIZE', '10000'))
+RASP_MESSAGES_TTL = float(getenv('RASP_MESSAGES_TTL', str(14 * 24 * 3600)))
+
+SEND_WORKERS = int(getenv('SEND_WORKERS', '8'))
+SEND_RATE = float(getenv('SEND_RATE', '25'))
+
+PARSE_WORKERS = int(getenv('PARSE_WORKERS', str(os.cpu_count() or 1)))
+PARSE_MODE = getenv('PARSE_MODE', 'process')
+
+STATE_BACKEND = getenv('STATE_BACKEND', 'memory')
+STATE_SQLITE_PATH = getenv('STATE_SQLITE_PATH', 'state.sqlite')
+SCHEDULER_LOCK = getenv('SCHEDULER_LOCK', 'kbprasp_scheduler')
+
 MESSAGES = {}
 
 def load_messages():
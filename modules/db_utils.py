@@ -1,10 +1,18 @@
+import logging
+import re
+import time
+from bisect import bisect_left
 import mysql.connector as mysql
 from contextlib import closing
 from .config import MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE, MESSAGES
 from telethon import events
 from typing import Callable
 from enum import Enum
+from datetime import datetime
 from functools import wraps
+from dataclasses import dataclass
+from itertools import chain
+from .journal import Mark
 
 __config = {
     'host': MYSQL_HOST,
@@ -13,7 +21,22 @@ __config = {
     'database': MYSQL_DATABASE
 }
 
-pool = mysql.pooling.MySQLConnectionPool(pool_name='mysql', **__config)
+class Pool:
+    # connections are opened on first use instead of at import
+    def __init__(self, **config):
+        self.__config = config
+        self.__pool: mysql.pooling.MySQLConnectionPool | None = None
+
+    def get_connection(self) -> mysql.pooling.PooledMySQLConnection:
+        if self.__pool is None:
+            self.__pool = mysql.pooling.MySQLConnectionPool(**self.__config)
+        return self.__pool.get_connection()
+
+pool = Pool(pool_name='mysql', **__config)
+
+def connect(**options) -> mysql.MySQLConnection:
+    # a connection of its own, for sessions that must outlive a pool checkout
+    return mysql.connect(**(__config | options))
 
 class Status(Enum):
     USER = 'user'
@@ -64,54 +87,141 @@ class RaspEntity:
     def __hash__(self):
         return hash((self.id, self.type.value, self.name))
 
-def get_rasp_entity(name: str | None = None, id: int | None = None, type: RaspEntityType | None = None) -> RaspEntity:
+# latin letters people type instead of the cyrillic ones that look the same, like common_translit but for every such letter
+name_folding = str.maketrans('abcehkmoptxyё', 'авсенкмортхуе')
+word_separator = re.compile(r'[\W_]+')
+
+def fold_name(name: str) -> str:
+    return name.strip().lower().translate(name_folding)
+
+@dataclass(frozen=True, slots=True)
+class RaspEntitySnapshot:
+    by_name: dict[str, RaspEntity]
+    by_id: dict[tuple[RaspEntityType, int], RaspEntity]
+    words: list[tuple[str, int]]
+    entities: list[RaspEntity]
+
+class RaspEntityIndex:
+    def __init__(self):
+        self.__snapshot = RaspEntitySnapshot({}, {}, [], [])
+        self.loaded = False
+
+    def load(self, entities: list[RaspEntity]):
+        by_name: dict[str, RaspEntity] = {}
+        for entity in entities:
+            by_name.setdefault(fold_name(entity.name), entity)
+        words = sorted((word, i) for i, entity in enumerate(entities) for word in word_separator.split(fold_name(entity.name)) if word != '')
+        # load runs in an executor thread while handlers read, so readers take one snapshot and never see half of a reload
+        self.__snapshot = RaspEntitySnapshot(by_name, {(entity.type, entity.id): entity for entity in entities}, words, list(entities))
+        self.loaded = True
+
+    def get(self, name: str) -> RaspEntity | None:
+        return self.__snapshot.by_name.get(fold_name(name))
+
+    def get_by_id(self, type: RaspEntityType, id: int) -> RaspEntity | None:
+        return self.__snapshot.by_id.get((type, id))
+
+    def find(self, name: str, limit: int = 6) -> list[RaspEntity]:
+        snapshot = self.__snapshot
+        words, entities = snapshot.words, snapshot.entities
+        scores: dict[int, list[int]] = {}
+        for query_word in set(word_separator.split(fold_name(name))):
+            if query_word == '':
+                continue
+            matched: dict[int, int] = {}
+            i = bisect_left(words, (query_word, -1))
+            while i < len(words) and words[i][0].startswith(query_word):
+                word, entity = words[i]
+                matched[entity] = max(matched.get(entity, 0), 2 if word == query_word else 1)
+                i += 1
+            for entity, exact in matched.items():
+                score = scores.setdefault(entity, [0, 0])
+                score[0] += 1
+                score[1] += exact
+        # names matching every query word hide partial matches, then whole words go before prefixes and shorter names first
+        best = max((score[0] for score in scores.values()), default=0)
+        ranked = sorted((entity for entity in scores if scores[entity][0] == best), key=lambda entity: (-scores[entity][1], len(entities[entity].name), entities[entity].name))
+        return [entities[entity] for entity in ranked[:limit]]
+
+rasp_entity_index = RaspEntityIndex()
+
+def load_rasp_entities():
     with closing(pool.get_connection()) as con:
         with closing(con.cursor()) as cur:
-            data = {}
-            if name is not None:
-                data['name'] = name
-            if id is not None:
-                data['entity_id'] = id
-            if type is not None:
-                data['type'] = type.value
-            if len(data) == 0:
-                raise NameError('No data provided')
-            condition = ' AND '.join(map(lambda key: f'{key} = %({key})s', data))
-            cur.execute(f'SELECT `entity_id`, `type`, `name` FROM `rasp_entities` WHERE {condition}', data)
-            res = cur.fetchone()
-            if res is None:
-                raise NameError('No such entity')
-            return RaspEntity(res[0], RaspEntityType(res[1]), res[2])
-
-def update_rasp_entities(entities: list[RaspEntity]):
+            cur.execute('SELECT `entity_id`, `type`, `name` FROM `rasp_entities` ORDER BY `id`')
+            rasp_entity_index.load([RaspEntity(r[0], RaspEntityType(r[1]), r[2]) for r in cur.fetchall()])
+
+def ensure_rasp_entities():
+    if not rasp_entity_index.loaded:
+        load_rasp_entities()
+
+def get_rasp_entity(name: str | None = None, id: int | None = None, type: RaspEntityType | None = None) -> RaspEntity:
+    ensure_rasp_entities()
+    if name is not None:
+        entity = rasp_entity_index.get(name)
+    elif id is not None and type is not None:
+        entity = rasp_entity_index.get_by_id(type, id)
+    else:
+        raise NameError('No data provided')
+    if entity is None:
+        raise NameError('No such entity')
+    return entity
+
+def update_rasp_entities(entities: list[RaspEntity]) -> int:
+    started = time.monotonic()
     with closing(pool.get_connection()) as con:
         with closing(con.cursor()) as cur:
+            cur.execute('SELECT `id`, `entity_id`, `type`, `name` FROM `rasp_entities`')
+            by_name: dict[tuple[str, str], list] = {}
+            by_entity_id: dict[tuple[str, int], list] = {}
+            for id, entity_id, type, name in cur.fetchall():
+                row = [id, entity_id, type, name]
+                by_name[(type, name)] = row
+                by_entity_id[(type, entity_id)] = row
+
+            inserts: list[list] = []
+            updates: dict[int, list] = {}
+            deletes: list[int] = []
             for entity in entities:
-                cur.execute('SELECT `entity_id`, `type`, `name` FROM `rasp_entities` WHERE `name` = %s AND type = %s', (entity.name, entity.type.value))
-                res = cur.fetchone()
-                if res is not None:
-                    if res[0] == entity.id:
-                        continue
-                    cur.execute('SELECT `id` FROM `rasp_entities` WHERE `entity_id` = %s AND `type` = %s', (entity.id, entity.type.value))
-                    id = cur.fetchone()
-                    if id is not None:
-                        cur.execute('DELETE FROM `rasp_entities` WHERE `id` = %s', (id[0],))
-                    cur.execute('UPDATE `rasp_entities` SET `entity_id` = %s WHERE `type` = %s AND `name` = %s', (entity.id, entity.type.value, entity.name))
+                type = entity.type.value
+                row = by_name.get((type, entity.name))
+                if row is not None and row[1] == entity.id:
+                    continue
+                other = by_entity_id.pop((type, entity.id), None)
+                if row is None and other is not None:
+                    # the entity was renamed on kbp.by, keep its row so users stay subscribed
+                    by_name.pop((type, other[3]), None)
+                    other[3] = entity.name
+                    row = other
+                elif other is not None and other is not row:
+                    by_name.pop((type, other[3]), None)
+                    if other[0] is not None:
+                        deletes.append(other[0])
+                        updates.pop(other[0], None)
+                    else:
+                        inserts.remove(other)
+                if row is None:
+                    row = [None, entity.id, type, entity.name]
+                    inserts.append(row)
                 else:
-                    cur.execute('SELECT `id` FROM `rasp_entities` WHERE `entity_id` = %s AND `type` = %s', (entity.id, entity.type.value))
-                    id = cur.fetchone()
-                    if id is not None:
-                        cur.execute('DELETE FROM `rasp_entities` WHERE `id` = %s', (id[0],))
-                    cur.execute('INSERT INTO `rasp_entities` (`entity_id`, `type`, `name`) VALUES (%s, %s, %s)', (entity.id, entity.type.value, entity.name))
-                con.commit()
+                    by_entity_id.pop((type, row[1]), None)
+                    row[1] = entity.id
+                    if row[0] is not None:
+                        updates[row[0]] = row
+                by_name[(type, entity.name)] = row
+                by_entity_id[(type, entity.id)] = row
+
+            cur.executemany('DELETE FROM `rasp_entities` WHERE `id` = %s', [(id,) for id in deletes])
+            cur.executemany('UPDATE `rasp_entities` SET `entity_id` = %s, `name` = %s WHERE `id` = %s', [(row[1], row[3], row[0]) for row in updates.values()])
+            cur.executemany('INSERT INTO `rasp_entities` (`entity_id`, `type`, `name`) VALUES (%s, %s, %s)', [(row[1], row[2], row[3]) for row in inserts])
+            con.commit()
+    rasp_entity_index.load([RaspEntity(row[1], RaspEntityType(row[2]), row[3]) for row in by_entity_id.values()])
+    logging.info('update_rasp_entities: %d entities, %d inserted, %d updated, %d deleted in %.2fs', len(entities), len(inserts), len(updates), len(deletes), time.monotonic() - started)
+    return len(inserts) + len(updates) + len(deletes)
 
-def find_rasp_entity(name: str) -> list[RaspEntity] | None:
-    with closing(pool.get_connection()) as con:
-        with closing(con.cursor()) as cur:
-            search_string = name.replace('*', '').replace(' ', '*') + '*'
-            cur.execute('SELECT `entity_id`, `type`, `name`, MATCH (name) AGAINST (%(search_string)s IN BOOLEAN MODE) AS prob FROM `rasp_entities` WHERE MATCH (name) AGAINST (%(search_string)s IN BOOLEAN MODE) > 0 ORDER BY prob DESC LIMIT 6', {'search_string': search_string})
-            res = cur.fetchall()
-            return [RaspEntity(r[0], RaspEntityType(r[1]), r[2]) for r in res]
+def find_rasp_entity(name: str) -> list[RaspEntity]:
+    ensure_rasp_entities()
+    return rasp_entity_index.find(name)
 
 def get_ej_group_id(group_name: str) -> int:
     group_name = group_name.upper()
@@ -132,163 +242,154 @@ def get_ej_group_name(group_id: int) -> str:
                 raise NameError('Group {} not found'.format(group_id))
             return result[0]
     
+user_select = 'SELECT u.`chat_id`, u.`status`, u.`ej_sub`, u.`surname`, u.`ej_group`, u.`birth`, u.`show_timestamps`, u.`show_extended_info`, u.`ej_fingerprint`, r.`entity_id`, r.`type`, r.`name`, s.`entity_id`, s.`type`, s.`name` FROM `users` AS u LEFT JOIN `rasp_entities` AS r ON u.`rasp_entity` = r.`id` LEFT JOIN `rasp_entities` AS s ON u.`sub_entity` = s.`id`'
+
+rasp_entity_id_select = '(SELECT `id` FROM `rasp_entities` WHERE `entity_id` = %s AND `type` = %s AND `name` = %s)'
+
 class User:
-    def __init__(self, chat_id: int):
+    def __init__(self, chat_id: int, row: tuple | None = None):
+        self.chat_id = chat_id
+        self.__changes: dict[str, tuple[str, tuple]] = {}
+        if row is None:
+            row = self.__load()
+        self.__status = Status(row[1])
+        self.__ej_sub = bool(row[2])
+        self.__surname: str | None = row[3]
+        self.__ej_group: int | None = row[4]
+        self.__birth: str | None = row[5]
+        self.__show_timestamps = bool(row[6])
+        self.__show_extended_info = bool(row[7])
+        self.__ej_fingerprint: str | None = row[8]
+        self.__rasp_entity = RaspEntity(row[9], RaspEntityType(row[10]), row[11]) if row[9] is not None else None
+        self.__sub_entity = RaspEntity(row[12], RaspEntityType(row[13]), row[14]) if row[12] is not None else None
+
+    def __load(self) -> tuple:
         with closing(pool.get_connection()) as con:
             with closing(con.cursor()) as cur:
-                cur.execute('SELECT EXISTS(SELECT * FROM `users` WHERE `chat_id` = %s)', (chat_id,))
-                result = cur.fetchone()[0]
-                if result == False:
-                    cur.execute('INSERT INTO `users` (`chat_id`, `status`) VALUES (%s, %s)', (chat_id, 'user' if chat_id > 0 else 'group'))
+                cur.execute(user_select + ' WHERE u.`chat_id` = %s', (self.chat_id,))
+                row = cur.fetchone()
+                if row is None:
+                    status = 'user' if self.chat_id > 0 else 'group'
+                    cur.execute('INSERT INTO `users` (`chat_id`, `status`) VALUES (%s, %s) ON DUPLICATE KEY UPDATE `chat_id` = `chat_id`', (self.chat_id, status))
                     con.commit()
-        self.chat_id = chat_id
+                    row = (self.chat_id, status, False, None, None, None, False, False, None, None, None, None, None, None, None)
+                return row
 
-    @property
-    def show_timestamps(self) -> bool:
+    def __change(self, column: str, value: any, expression: str = '%s'):
+        self.__changes[column] = (expression, value if type(value) is tuple else (value,))
+
+    def commit(self):
+        if len(self.__changes) == 0:
+            return
+        assignments = ', '.join(f'`{column}` = {expression}' for column, (expression, _) in self.__changes.items())
+        params = tuple(chain.from_iterable(values for _, values in self.__changes.values()))
         with closing(pool.get_connection()) as con:
             with closing(con.cursor()) as cur:
-                cur.execute('SELECT `show_timestamps` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: int = cur.fetchone()[0]
-                return bool(result)
+                cur.execute(f'UPDATE `users` SET {assignments} WHERE `chat_id` = %s', params + (self.chat_id,))
+                con.commit()
+        self.__changes.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commit()
+
+    @property
+    def show_timestamps(self) -> bool:
+        return self.__show_timestamps
 
     @show_timestamps.setter
     def show_timestamps(self, value: bool):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `show_timestamps` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__show_timestamps = value
+        self.__change('show_timestamps', value)
 
     @property
     def show_extended_info(self) -> bool:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `show_extended_info` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: int = cur.fetchone()[0]
-                return bool(result)
+        return self.__show_extended_info
 
     @show_extended_info.setter
     def show_extended_info(self, value: bool):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `show_extended_info` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__show_extended_info = value
+        self.__change('show_extended_info', value)
 
     @property
     def rasp_entity(self) -> RaspEntity | None:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT e.`entity_id`, e.`type`, e.`name` FROM `users` JOIN `rasp_entities` AS e ON `rasp_entity` = e.`id` WHERE `chat_id` = %s', (self.chat_id,))
-                result = cur.fetchone()
-                if result is None:
-                    return None
-                return RaspEntity(result[0], RaspEntityType(result[1]), result[2])
-        
+        return self.__rasp_entity
+
     @rasp_entity.setter
     def rasp_entity(self, value: RaspEntity | None):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                rasp_entity_id: int = None
-                if value is not None:
-                    cur.execute('SELECT `id` FROM `rasp_entities` WHERE `entity_id` = %s AND `type` = %s AND `name` = %s', (value.id, value.type.value, value.name))
-                    rasp_entity_id = cur.fetchone()[0]
-                cur.execute('UPDATE `users` SET `rasp_entity` = %s WHERE `chat_id` = %s', (rasp_entity_id, self.chat_id))
-                con.commit()
+        self.__rasp_entity = value
+        if value is None:
+            self.__change('rasp_entity', None)
+        else:
+            self.__change('rasp_entity', (value.id, value.type.value, value.name), rasp_entity_id_select)
 
     @property
     def sub_entity(self) -> RaspEntity | None:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT e.`entity_id`, e.`type`, e.`name` FROM `users` JOIN `rasp_entities` AS e ON `sub_entity` = e.`id` WHERE `chat_id` = %s', (self.chat_id,))
-                result = cur.fetchone()
-                if result is None:
-                    return None
-                return RaspEntity(result[0], RaspEntityType(result[1]), result[2])
-        
+        return self.__sub_entity
+
     @sub_entity.setter
     def sub_entity(self, value: RaspEntity | None):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                sub_entity_id: int = None
-                if value is not None:
-                    cur.execute('SELECT `id` FROM `rasp_entities` WHERE `entity_id` = %s AND `type` = %s AND `name` = %s', (value.id, value.type.value, value.name))
-                    sub_entity_id = cur.fetchone()[0]
-                cur.execute('UPDATE `users` SET `sub_entity` = %s WHERE `chat_id` = %s', (sub_entity_id, self.chat_id))
-                con.commit()
-            
+        self.__sub_entity = value
+        if value is None:
+            self.__change('sub_entity', None)
+        else:
+            self.__change('sub_entity', (value.id, value.type.value, value.name), rasp_entity_id_select)
+
     @property
     def surname(self) -> str | None:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `surname` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: str = cur.fetchone()[0]
-                return result
+        return self.__surname
 
     @surname.setter
     def surname(self, value: str | None):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `surname` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__surname = value
+        self.__change('surname', value)
 
     @property
     def ej_group(self) -> int | None:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `ej_group` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: int = cur.fetchone()[0]
-                return result
+        return self.__ej_group
 
     @ej_group.setter
     def ej_group(self, value: int | None):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `ej_group` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__ej_group = value
+        self.__change('ej_group', value)
 
     @property
     def ej_sub(self) -> bool:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `ej_sub` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: int = cur.fetchone()[0]
-                return bool(result)
-    
+        return self.__ej_sub
+
     @ej_sub.setter
     def ej_sub(self, value: bool):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `ej_sub` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__ej_sub = value
+        self.__change('ej_sub', value)
 
     @property
     def birth(self) -> str | None:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `birth` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: str = cur.fetchone()[0]
-                return result
-        
+        return self.__birth
+
     @birth.setter
     def birth(self, value: str | None):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `birth` = %s WHERE `chat_id` = %s', (value, self.chat_id))
-                con.commit()
+        self.__birth = value
+        self.__change('birth', value)
+
+    @property
+    def ej_fingerprint(self) -> str | None:
+        return self.__ej_fingerprint
+
+    @ej_fingerprint.setter
+    def ej_fingerprint(self, value: str | None):
+        self.__ej_fingerprint = value
+        self.__change('ej_fingerprint', value)
 
     @property
     def status(self) -> Status:
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('SELECT `status` FROM `users` WHERE `chat_id` = %s', (self.chat_id,))
-                result: str = cur.fetchone()[0]
-                return Status(result)
-        
+        return self.__status
+
     @status.setter
     def status(self, value: Status):
-        with closing(pool.get_connection()) as con:
-            with closing(con.cursor()) as cur:
-                cur.execute('UPDATE `users` SET `status` = %s WHERE `chat_id` = %s', (value.value, self.chat_id))
-                con.commit()
+        self.__status = value
+        self.__change('status', value.value)
 
     def __getitem__(self, item: str):
         match item:
@@ -339,25 +440,53 @@ class User:
 def get_subs() -> dict[RaspEntity, list[User]]:
     with closing(pool.get_connection()) as con:
         with closing(con.cursor()) as cur:
-            cur.execute('SELECT DISTINCT(`sub_entity`) FROM `users` WHERE `sub_entity` IS NOT NULL')
-            result = cur.fetchall()
-            rasp_entities_ids = [r[0] for r in result]
+            cur.execute(user_select + ' WHERE u.`sub_entity` IS NOT NULL ORDER BY u.`sub_entity`')
             subs = {}
-            for rasp_entity_id in rasp_entities_ids:
-                cur.execute('SELECT `entity_id`, `type`, `name` FROM `rasp_entities` WHERE `id` = %s', (rasp_entity_id,))
-                result = cur.fetchone()
-                rasp_entity = RaspEntity(result[0], RaspEntityType(result[1]), result[2])
-                cur.execute('SELECT `chat_id` FROM `users` WHERE `sub_entity` = %s', (rasp_entity_id,))
-                result = cur.fetchall()
-                subs[rasp_entity] = [User(int(r[0])) for r in result]
+            for row in cur:
+                user = User(int(row[0]), row)
+                subs.setdefault(user.sub_entity, []).append(user)
             return subs
 
 def get_ej_subs() -> list[User]:
     with closing(pool.get_connection()) as con:
         with closing(con.cursor()) as cur:
-            cur.execute('SELECT `chat_id` FROM `users` WHERE `ej_sub` = 1')
+            cur.execute(user_select + ' WHERE u.`ej_sub` = 1')
             result = cur.fetchall()
-            return [User(int(r[0])) for r in result]
+            return [User(int(r[0]), r) for r in result]
+
+def update_ej_fingerprints(fingerprints: dict[int, str]):
+    if len(fingerprints) == 0:
+        return
+    with closing(pool.get_connection()) as con:
+        with closing(con.cursor()) as cur:
+            cur.executemany('UPDATE `users` SET `ej_fingerprint` = %s WHERE `chat_id` = %s', [(fingerprint, chat_id) for chat_id, fingerprint in fingerprints.items()])
+            con.commit()
+
+# rows are (chat_id, message_id, entity type, entity_id, date, unix time of the last use)
+def get_rasp_message(chat_id: int, message_id: int, max_age: float) -> tuple[int, int, str, int, datetime, float] | None:
+    with closing(pool.get_connection()) as con:
+        with closing(con.cursor()) as cur:
+            cur.execute(
+                'SELECT `chat_id`, `message_id`, `type`, `entity_id`, `date`, UNIX_TIMESTAMP(`used_at`) FROM `rasp_messages` '
+                'WHERE `chat_id` = %s AND `message_id` = %s AND `used_at` > NOW() - INTERVAL %s SECOND',
+                (str(chat_id), message_id, int(max_age))
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return (int(row[0]), row[1], row[2], row[3], row[4], float(row[5]))
+
+def get_recent_rasp_messages(limit: int, max_age: float) -> list[tuple[int, int, str, int, datetime, float]]:
+    with closing(pool.get_connection()) as con:
+        with closing(con.cursor()) as cur:
+            cur.execute('DELETE FROM `rasp_messages` WHERE `used_at` < NOW() - INTERVAL %s SECOND', (int(max_age),))
+            con.commit()
+            cur.execute(
+                'SELECT `chat_id`, `message_id`, `type`, `entity_id`, `date`, UNIX_TIMESTAMP(`used_at`) FROM `rasp_messages` '
+                'ORDER BY `used_at` DESC LIMIT %s',
+                (limit,)
+            )
+            return [(int(row[0]), row[1], row[2], row[3], row[4], float(row[5])) for row in cur.fetchall()]
 
 def get_all_users() -> list[int]:
     with closing(pool.get_connection()) as con:
@@ -368,37 +497,31 @@ def get_all_users() -> list[int]:
 
 def with_user(f: Callable):
     @wraps(f)
-    def wrapper(event: events.NewMessage.Event | events.CallbackQuery.Event, *args, **kwargs):        
-        return f(event, User(event.chat_id), *args, **kwargs)
+    async def wrapper(event: events.NewMessage.Event | events.CallbackQuery.Event, *args, **kwargs):
+        with User(event.chat_id) as user:
+            return await f(event, user, *args, **kwargs)
     return wrapper
 
-class Mark:
-    def __init__(self, mark: str = '', name: str = '', month: str = '', day: str = '', title: str = ''):
-        self.mark = mark
-        self.name = name
-        self.month = month
-        self.day = day
-        self.title = title
-
-    def __hash__(self):
-        return hash((self.mark, self.name, self.month, self.day, self.title))
-
-    def __eq__(self, other):
-        if not isinstance(other, type(self)): return NotImplemented
-        return self.mark == other.mark and self.name == other.name and self.month == other.month and self.day == other.day and self.title == other.title
-    
-def get_marks(user: User) -> list[Mark]:
-    with closing(pool.get_connection()) as con:
-        with closing(con.cursor()) as cur:
-            cur.execute('SELECT `mark`, `name`, `month`, `day`, `title` FROM `ej_marks` WHERE `chat_id` = %s', (user.chat_id,))
-            result = cur.fetchall()
-            return [Mark(*r) for r in result]
-
-def add_marks(user: User, marks: list[Mark]):
+def add_new_marks(marks: dict[User, list[Mark]]) -> dict[int, list[Mark]]:
+    new_marks = {user.chat_id: [] for user in marks}
+    rows = [(user.chat_id, mark.digest, mark.mark, mark.name, mark.month, mark.day, mark.title) for user, user_marks in marks.items() for mark in user_marks]
+    if len(rows) == 0:
+        return new_marks
     with closing(pool.get_connection()) as con:
         with closing(con.cursor()) as cur:
-            cur.executemany('INSERT INTO `ej_marks` (`chat_id`, `mark`, `name`, `month`, `day`, `title`) VALUES (%s, %s, %s, %s, %s, %s)', [(user.chat_id,)+tuple(mark.__dict__.values()) for mark in marks])
+            # the unique (chat_id, hash) key drops known marks, and the snapshot taken by the first select
+            # keeps other connections' inserts out, so only the rows inserted here have a bigger id.
+            # not INSERT IGNORE, it would also turn strict mode errors like a too long value into silent truncation
+            cur.execute('SELECT COALESCE(MAX(`id`), 0) FROM `ej_marks`')
+            last_id = cur.fetchone()[0]
+            cur.executemany('INSERT INTO `ej_marks` (`chat_id`, `hash`, `mark`, `name`, `month`, `day`, `title`) VALUES (%s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE `id` = `id`', rows)
+            if cur.rowcount > 0:
+                placeholders = ', '.join(['%s'] * len(new_marks))
+                cur.execute(f'SELECT `chat_id`, `mark`, `name`, `month`, `day`, `title` FROM `ej_marks` WHERE `id` > %s AND `chat_id` IN ({placeholders}) ORDER BY `id`', [last_id, *new_marks])
+                for r in cur:
+                    new_marks[int(r[0])].append(Mark(*r[1:]))
             con.commit()
+            return new_marks
 
 def get_average_data(user: User) -> list[Mark]:
     with closing(pool.get_connection()) as con:
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+from telethon.errors import FloodWaitError
+from .config import SEND_WORKERS, SEND_RATE
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.__next = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self.__next - now
+        self.__next = max(now, self.__next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self.__next = max(self.__next, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        return self.__next <= time.monotonic()
+
+class Delivery:
+    def __init__(self, chat_id: int, send: Callable[[], Awaitable]):
+        self.chat_id = chat_id
+        self.send = send
+        self.attempts = 0
+
+class DispatchStats:
+    def __init__(self, name: str, total: int):
+        self.name = name
+        self.total = total
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self.delivered = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.latencies: list[float] = []
+
+    def add_delivery(self):
+        self.delivered += 1
+        self.latencies.append(time.monotonic() - self.started)
+
+    @property
+    def first_delivery(self) -> float | None:
+        return min(self.latencies, default=None)
+
+    @property
+    def last_delivery(self) -> float | None:
+        return max(self.latencies, default=None)
+
+    @property
+    def throughput(self) -> float:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.delivered / elapsed if elapsed > 0 else 0.0
+
+    def percentile(self, p: float) -> float | None:
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def __str__(self):
+        return '{}: {}/{} delivered, {} failed, {} flood waits, {:.1f} msg/s, latency p50={}, p90={}, p99={}, max={}'.format(
+            self.name, self.delivered, self.total, self.failed, self.flood_waits, self.throughput,
+            *('{:.2f}s'.format(l) if l is not None else '-' for l in (self.percentile(50), self.percentile(90), self.percentile(99), self.last_delivery))
+        )
+
+class Dispatcher:
+    def __init__(self, workers: int, rate: float, chat_rate: float = 1, group_rate: float = 20 / 60, max_attempts: int = 3, global_flood_wait: float = 3):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.global_flood_wait = global_flood_wait
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.__limiter = RateLimiter(rate)
+        self.__chat_limiters: dict[int, RateLimiter] = {}
+        self.__requeues: set[asyncio.Task] = set()
+
+    def __get_chat_limiter(self, chat_id: int) -> RateLimiter:
+        if chat_id not in self.__chat_limiters:
+            self.__chat_limiters[chat_id] = RateLimiter(self.chat_rate if chat_id > 0 else self.group_rate)
+        return self.__chat_limiters[chat_id]
+
+    async def run(self, name: str, deliveries: list[Delivery]) -> DispatchStats:
+        stats = DispatchStats(name, len(deliveries))
+        queue: asyncio.Queue[Delivery] = asyncio.Queue()
+        for delivery in deliveries:
+            queue.put_nowait(delivery)
+        workers = [asyncio.create_task(self.__worker(queue, stats)) for _ in range(min(self.workers, len(deliveries)))]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        stats.finished = time.monotonic()
+        # an idle limiter behaves like a new one, so dropping it only frees memory
+        self.__chat_limiters = {chat_id: limiter for chat_id, limiter in self.__chat_limiters.items() if not limiter.idle}
+        logging.info(stats)
+        return stats
+
+    async def __requeue(self, queue: asyncio.Queue, delivery: Delivery, delay: float):
+        await asyncio.sleep(delay)
+        queue.put_nowait(delivery)
+        queue.task_done()
+
+    async def __worker(self, queue: asyncio.Queue, stats: DispatchStats):
+        while True:
+            delivery = await queue.get()
+            requeued = False
+            try:
+                chat_limiter = self.__get_chat_limiter(delivery.chat_id)
+                await chat_limiter.acquire()
+                await self.__limiter.acquire()
+                delivery.attempts += 1
+                await delivery.send()
+                stats.add_delivery()
+            except FloodWaitError as e:
+                stats.flood_waits += 1
+                chat_limiter.pause(e.seconds)
+                # long flood waits during a broadcast are usually for the whole account, not just this chat
+                if e.seconds > self.global_flood_wait:
+                    self.__limiter.pause(e.seconds)
+                if delivery.attempts < self.max_attempts:
+                    # the task stays unfinished until the delivery is back in the queue, so run() keeps waiting for it
+                    task = asyncio.create_task(self.__requeue(queue, delivery, e.seconds))
+                    self.__requeues.add(task)
+                    task.add_done_callback(self.__requeues.discard)
+                    requeued = True
+                else:
+                    stats.failed += 1
+                    logging.error('%s: giving up on chat %d after %d flood waits', stats.name, delivery.chat_id, delivery.attempts)
+            except Exception as e:
+                stats.failed += 1
+                logging.error(e, exc_info=True)
+            finally:
+                if not requeued:
+                    queue.task_done()
+
+dispatcher = Dispatcher(SEND_WORKERS, SEND_RATE)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+import aiohttp
+from multidict import CIMultiDictProxy
+from .config import HTTP_TIMEOUT, HTTP_RETRIES, KBP_CONCURRENCY, EJ_CONCURRENCY
+
+class Response:
+    def __init__(self, status: int, headers: CIMultiDictProxy, content: bytes):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+class Fetcher:
+    def __init__(self, timeout: float, retries: int, limits: dict[str, int], default_limit: int = 4, backoff: float = 0.5):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.limits = limits
+        self.default_limit = default_limit
+        self.__session: aiohttp.ClientSession | None = None
+        self.__semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self.__session is None or self.__session.closed:
+            # cookies are passed explicitly per request, so the shared session must not keep them between users
+            connector = aiohttp.TCPConnector(limit_per_host=max(self.limits.values(), default=self.default_limit), keepalive_timeout=30)
+            self.__session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, cookie_jar=aiohttp.DummyCookieJar())
+        return self.__session
+
+    def __get_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self.__semaphores:
+            self.__semaphores[host] = asyncio.Semaphore(self.limits.get(host, self.default_limit))
+        return self.__semaphores[host]
+
+    async def request(self, method: str, url: str, headers: dict[str, str] | None = None, data: dict | None = None) -> Response:
+        session = self.__get_session()
+        semaphore = self.__get_semaphore(urlsplit(url).hostname)
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    async with session.request(method, url, headers=headers, data=data) as res:
+                        content = await res.read()
+                        if res.status >= 500:
+                            res.raise_for_status()
+                        return Response(res.status, res.headers, content)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning('%s %s failed (%s), retrying in %.1fs', method, url, repr(e), delay)
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def get(self, url: str, headers: dict[str, str] | None = None) -> Response:
+        return await self.request('GET', url, headers=headers)
+
+    async def post(self, url: str, data: dict | None = None, headers: dict[str, str] | None = None) -> Response:
+        return await self.request('POST', url, headers=headers, data=data)
+
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+
+fetcher = Fetcher(HTTP_TIMEOUT, HTTP_RETRIES, {'kbp.by': KBP_CONCURRENCY, 'ej.kbp.by': EJ_CONCURRENCY})
@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import re
+from lxml import html, etree
+from io import BytesIO
+from itertools import chain
+from dataclasses import dataclass
+
+class Mark:
+    def __init__(self, mark: str = '', name: str = '', month: str = '', day: str = '', title: str = ''):
+        self.mark = mark
+        self.name = name
+        self.month = month
+        self.day = day
+        self.title = title
+
+    @property
+    def digest(self) -> str:
+        # same as MD5(CONCAT_WS(CHAR(31), mark, name, month, day, COALESCE(title, ''))) in MySQL
+        return hashlib.md5('\x1f'.join((self.mark, self.name, self.month, self.day, self.title or '')).encode(), usedforsecurity=False).hexdigest()
+
+    def __hash__(self):
+        return hash((self.mark, self.name, self.month, self.day, self.title))
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)): return NotImplemented
+        return self.mark == other.mark and self.name == other.name and self.month == other.month and self.day == other.day and self.title == other.title
+
+monthlabels = {'январь': '01', 'февраль': '02', 'март': '03', 'апрель': '04', 'май': '05', 'июнь': '06', 'июль': '07', 'август': '08', 'сентябрь': '09', 'октябрь': '10', 'ноябрь': '11', 'декабрь': '12'}
+
+divs_xpath = etree.XPath('.//div')
+spans_xpath = etree.XPath('.//span')
+rows_xpath = etree.XPath('.//tr')
+cells_xpath = etree.XPath('.//td')
+text_xpath = etree.XPath('string()', smart_strings=False)
+
+@dataclass(slots=True)
+class JournalData:
+    marks: list[Mark]
+    average: list[Mark] | None
+
+def column_tag(name: str) -> re.Pattern:
+    return re.compile(rb'<\w+[^>]*\sclass\s*=\s*["\']?(?:[^"\'>]*\s)?' + name.encode() + rb'[\s"\'>]', re.IGNORECASE)
+
+left_column_tag = column_tag('leftColumn')
+right_column_tag = column_tag('rightColumn')
+table_tag = re.compile(rb'<(/?)table\b', re.IGNORECASE)
+
+def table_end(content: bytes, start: int) -> int:
+    # the end of the first table after start, past the tables nested in it
+    depth = 0
+    for tag in table_tag.finditer(content, start):
+        if tag.group(1):
+            if depth == 0:
+                continue
+            depth -= 1
+            if depth == 0:
+                return tag.end()
+        else:
+            depth += 1
+    return -1
+
+def journal_fingerprint(content: bytes) -> str:
+    # the mark table without whitespace, so an unchanged journal is recognized before parsing it.
+    # anchored on the class attributes, the names may also appear in styles and scripts before the columns
+    left = left_column_tag.search(content)
+    right = right_column_tag.search(content)
+    end = table_end(content, right.start()) if right is not None else -1
+    region = content[left.start():end] if left is not None and end != -1 and left.start() < end else content
+    return hashlib.blake2b(b''.join(region.split()), digest_size=16).hexdigest()
+
+def parse_page(content: bytes) -> etree._ElementTree:
+    return html.parse(BytesIO(content), parser=html.HTMLParser(encoding='utf-8'))
+
+def parse_journal(content: bytes) -> JournalData:
+    page = parse_page(content)
+    # marks are sent to subscribers, so a page whose averages can't be read must not cost them the marks
+    try:
+        average = extract_average(page)
+    except Exception as e:
+        logging.warning('journal averages not parsed: %s', repr(e))
+        average = None
+    return JournalData(extract_marks(page), average)
+
+def parse_ej(content: bytes) -> list[Mark]:
+    return extract_marks(parse_page(content))
+
+def parse_average(content: bytes) -> list[Mark]:
+    return extract_average(parse_page(content))
+
+def extract_marks(page: etree._ElementTree) -> list[Mark]:
+    marks = []
+    names = page.getroot().find_class('leftColumn').pop()
+    names_rows = rows_xpath(names)[2:-1]
+    mark_table = page.getroot().find_class('rightColumn').pop()
+    months = cells_xpath(mark_table.get_element_by_id('months'))[:-1]
+    days = [text_xpath(day) for day in divs_xpath(mark_table.get_element_by_id('dateOfMonth'))]
+    mark_rows = rows_xpath(mark_table)[2:-1]
+
+    # month label of every column, built once per page instead of summing colspans for every mark
+    column_months = list(chain.from_iterable([text_xpath(divs_xpath(month)[-1])] * int(month.get('colspan')) for month in months))
+
+    for names_row, mark_row in zip(names_rows, mark_rows):
+        name = text_xpath(divs_xpath(names_row)[-1]).strip()
+        for j, column in enumerate(cells_xpath(mark_row)[:-1]):
+            div = divs_xpath(column)[-1]
+            spans = spans_xpath(div)
+            if len(spans) == 0:
+                continue
+            mark = Mark()
+            mark.title = div.get('title')
+            mark.name = name
+            mark.day = days[j]
+            if j < len(column_months):
+                mark.month = monthlabels[column_months[j]]
+            mark.mark = ' '.join(text_xpath(span) for span in spans)
+            marks.append(mark)
+
+    return marks
+
+def extract_average(page: etree._ElementTree) -> list[Mark]:
+    marks = []
+    names = page.getroot().find_class('leftColumn').pop()
+    names_rows = names.cssselect('tr')[2:-1]
+    mark_table = page.getroot().find_class('rightColumn').pop()
+    mark_rows = mark_table.cssselect('tr')[2:-1]
+    mark_columns = [row.cssselect('td').pop() for row in mark_rows]
+
+    sum = 0
+    count = 0
+    for i in range(len(names_rows)):
+        mark = Mark()
+        mark.name = names_rows[i].cssselect('div').pop().text_content().strip()
+        divs = mark_columns[i].cssselect('div')
+        mark.mark = divs[-1].text_content().strip() if len(divs) > 0 else '-'
+        marks.append(mark)
+        # '-', an empty cell or a pass/fail mark like 'зач' has no place in the overall average
+        try:
+            sum += float(mark.mark)
+            count += 1
+        except ValueError:
+            pass
+
+    general = Mark()
+    general.name = '\n**Общий**'
+    # the journal is parsed for marks and averages at once, so a journal without averages yet must not fail
+    general.mark = str(round(sum / count, 1)) if count > 0 else '-'
+    marks.append(general)
+
+    return marks
@@ -1,264 +1,280 @@
-from lxml import html
-from io import BytesIO
-import requests
-from functools import lru_cache
+import asyncio
+import hashlib
+import logging
 import time
-from .utils import cache
-from .db_utils import RaspEntity, RaspEntityType, Mark
-from enum import Enum
-from itertools import chain
-from .config import SCHEDULE
+from lxml import html, etree
+from io import BytesIO
+from .config import EJ_SESSION_TTL
+from .fetch import fetcher
+from .parsing import parse_service
+from .capture import ej_capture
+from .utils import cache, SingleFlight
+from .db_utils import RaspEntity, RaspEntityType
+from .state import StateMap
+from .timetable import PairType, Pair, Weekday, Timetable, parse_rasp, parse_rasp_list
+from .journal import Mark, JournalData, parse_journal, journal_fingerprint
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36'
 }
 
-class PairType(Enum):
-    DEFAULT = 'default'
-    REMOVED = 'removed'
-    EMPTY = 'empty'
-    ADDED = 'added'
-    CHANGED = 'changed'
-
-class Pair:
-    def __init__(self):
-        self.time: str = ''
-        self.number: int = 0
-        self.type: PairType = PairType.EMPTY
-        self.names: list[str] = []
-        self.places: list[str] = []
-        self.teachers: list[str] = []
-        self.groups: list[str] = []
-
-class Weekday:
-    __weeklabels = ['ПОНЕДЕЛЬНИК', 'ВТОРНИК', 'СРЕДА', 'ЧЕТВЕРГ', 'ПЯТНИЦА', 'СУББОТА']
-    def __init__(self, number: int, zamena: str):
-        self.number = number
-        self.zamena = zamena
-        self.pairs: list[Pair] = []
-
-    @property
-    def name(self) -> str:
-        return self.__weeklabels[self.number]
-
 class Rasp:
     __url = 'https://kbp.by/rasp/timetable/view_beta_kbp/?cat={}&id={}'
     __list_url = 'https://kbp.by/rasp/timetable/view_beta_kbp/?q='
 
-    def check_rasp(self, weekday: int, left_week: bool = True) -> bool:
-        html_page = requests.get(self.__url.format('group', '10'), headers=headers).content
-        page = html.parse(BytesIO(html_page))
-        zamena = page.getroot().get_element_by_id('left_week' if left_week else 'right_week').cssselect('tr')[1].cssselect('th')[weekday + 1].text_content()
+    __check_state: dict[str, dict] = {}
+
+    async def check_rasp(self, weekday: int, left_week: bool = True) -> bool:
+        week_id = 'left_week' if left_week else 'right_week'
+        state = self.__check_state.setdefault(week_id, {'etag': None, 'last_modified': None, 'hash': None, 'cells': None})
+        request_headers = dict(headers)
+        if state['cells'] is not None:
+            if state['etag'] is not None:
+                request_headers['If-None-Match'] = state['etag']
+            if state['last_modified'] is not None:
+                request_headers['If-Modified-Since'] = state['last_modified']
+
+        res = await fetcher.get(self.__url.format('group', '10'), headers=request_headers)
+        started = time.perf_counter()
+        result = 'not modified'
+        if res.status != 304:
+            state['etag'] = res.headers.get('ETag')
+            state['last_modified'] = res.headers.get('Last-Modified')
+            region = self.__zamena_region(res.content, week_id)
+            cells = None
+            if region is not None:
+                region_hash = hashlib.blake2b(region, digest_size=16).digest()
+                if region_hash == state['hash'] and state['cells'] is not None:
+                    result = 'header unchanged'
+                    cells = state['cells']
+                else:
+                    result = 'header parse'
+                    cells = self.__parse_zamena_region(region)
+            if cells is None:
+                # no region or one the pull parser could not split into rows, the markup may have changed
+                result = 'full parse'
+                page = html.parse(BytesIO(res.content))
+                cells = [th.text_content() for th in page.getroot().get_element_by_id(week_id).cssselect('tr')[1].cssselect('th')]
+                region_hash = None
+            state['cells'] = cells
+            state['hash'] = region_hash
+        # the body after decompression, a 304 has none
+        logging.info('check_rasp: %s, %d body bytes, %.2fms spent on the page', result, len(res.content), (time.perf_counter() - started) * 1000)
+
+        zamena = state['cells'][weekday + 1]
         return zamena.find('Замен нет') != -1 or zamena.find('Показать замены') != -1
 
-    def get_rasp_list(self) -> list[RaspEntity]:
-        html_page = requests.get(self.__list_url, headers=headers).content
-        page = html.parse(BytesIO(html_page))
-        rasp_list = []
+    def __zamena_region(self, content: bytes, week_id: str) -> bytes | None:
+        # the bytes from the week block up to the end of its second row, which holds the substitution labels
+        marker = content.find('id="{}"'.format(week_id).encode())
+        if marker == -1:
+            return None
+        start = content.rfind(b'<', 0, marker)
+        end = marker
+        for _ in range(2):
+            end = content.find(b'</tr>', end)
+            if end == -1:
+                return None
+            end += len(b'</tr>')
+        return content[start:end]
+
+    def __parse_zamena_region(self, region: bytes) -> list[str] | None:
+        parser = etree.HTMLPullParser(events=('end',), tag='tr', encoding='utf-8')
+        parser.feed(region)
+        rows = [element for _, element in parser.read_events()]
+        if len(rows) < 2:
+            return None
+        return [''.join(th.itertext()) for th in rows[1].iter('th')]
 
-        container = page.getroot().find_class('block_back')[0]
-        for entry in container.cssselect('div')[2:]:
-            type = RaspEntityType.by_label(entry.find_class('type_find')[0].text_content())
-            a = entry.cssselect('a')[0]
-            name = str(a.text_content())
-            id = int(a.get('href').split('=')[-1])
-            entity = RaspEntity(id, type, name)
-            rasp_list.append(entity)
-        return rasp_list
+    async def get_rasp_list(self) -> list[RaspEntity]:
+        html_page = (await fetcher.get(self.__list_url, headers=headers)).content
+        return [RaspEntity(id, RaspEntityType.by_label(label), name) for id, label, name in await parse_service.run(parse_rasp_list, html_page)]
     
-    @cache(copy=True, ttl=60)
-    def get_rasp(self, entity: RaspEntity) -> dict[str, list[Weekday]]:
-        html_page = requests.get(self.__url.format(entity.type.value, entity.id), headers=headers).content
-        page = html.parse(BytesIO(html_page))
-
-        rasp = {}
-
-        weekdiv = page.getroot().get_element_by_id('left_week')
-        rasp['left'] = self.__get_week(weekdiv)
-        weekdiv = page.getroot().get_element_by_id('right_week')
-        rasp['right'] = self.__get_week(weekdiv)
-
-        return rasp
-
-    def __get_week(self, weekdiv: html.HtmlElement) -> list[Weekday]:
-        rows = weekdiv.cssselect('tr')[1:-2]
-        zamena_row = rows.pop(0)
-        zamena_cells = zamena_row.cssselect('th')[1:-1]
-
-        rasp: list[Weekday] = []
-
-        for i, cell in enumerate(zamena_cells):
-            zamena_label = cell.text_content().strip()
-            if zamena_label == 'Показать замены':
-                zamena_label = 'Замены:'
-            rasp.append(Weekday(i, zamena_label))
-
-        for row in rows:
-            if len(row.find_class('pair')) == 0:
-                continue
-            cells = row.cssselect('td')[:-1]
-            number_cell = cells.pop(0)
-            pair_number = int(number_cell.text_content())
-            for i, cell in enumerate(cells):
-                pair = self.__extract_pair(cell)
-                pair.number = pair_number
-                match i:
-                    case 3:
-                        pair.time = SCHEDULE['thursday'][pair_number - 1]
-                    case 5:
-                        pair.time = SCHEDULE['saturday'][pair_number - 1]
-                    case _:
-                        pair.time = SCHEDULE['regular'][pair_number - 1]
-                rasp[i].pairs.append(pair)
-
-        return rasp
-
-    def __extract_pair(self, table_cell: html.HtmlElement) -> Pair:
-        pair_divs = table_cell.find_class('pair')
-
-        match len(pair_divs):
-            case 0:
-                return Pair()
-            case 1:
-                pair_div = pair_divs[0]
-                pair = Pair()
-                if 'removed' in pair_div.classes:
-                    pair.type = PairType.REMOVED
-                    pair.names.append('Урок снят')
-                elif 'added' in pair_div.classes:
-                    pair = self.__extract_pair_data(pair_div)
-                    pair.type = PairType.ADDED
-                else:
-                    pair = self.__extract_pair_data(pair_div)
-                    pair.type = PairType.DEFAULT
-                return pair
-            case _:
-                classes = chain.from_iterable(pair_div.classes for pair_div in pair_divs)
-                if 'removed' in classes:
-                    for pair_div in pair_divs:
-                        if 'added' in pair_div.classes:
-                            pair = self.__extract_pair_data(pair_div)
-                            if pair.names[0] == 'Урок снят':
-                                pair.type = PairType.REMOVED
-                                pair.places.pop()
-                            else:
-                                pair.type = PairType.CHANGED
-                            return pair
-                    pair = Pair()
-                    pair.type = PairType.REMOVED
-                    pair.names.append('Урок снят')
-                    return pair
-                else:
-                    pair = Pair()
-                    pair.type = PairType.DEFAULT
-                    for pair_div in pair_divs:
-                        pair_data = self.__extract_pair_data(pair_div)
-                        pair.names.extend(pair_data.names)
-                        pair.places.extend(pair_data.places)
-                        pair.groups.extend(pair_data.groups)
-                        pair.teachers.extend(pair_data.teachers)
-                    return pair
-
-    def __extract_pair_data(self, pair_div: html.HtmlElement) -> Pair:
-        pair = Pair()
-
-        pair.names.append(pair_div.find_class('subject')[0].text_content())
-        pair.places.append(pair_div.find_class('place')[0].text_content())
-        pair.groups.append(pair_div.find_class('group')[0].text_content())
-        teachers = pair_div.find_class('teacher')
-        pair.teachers.append(teachers[0].text_content())
-        second_teacher = teachers[1].text_content()
-        if second_teacher != '':
-            pair.teachers.append(second_teacher)
+    __rasp_flight = SingleFlight('get_rasp')
+    # the leader invalidates after a change, the other processes notice the new generation and drop their caches too
+    __rasp_generation = StateMap('rasp')
+    __rasp_generation_seen = 0
+    __rasp_generation_checked = 0.0
+
+    async def get_rasp(self, entity: RaspEntity) -> Timetable:
+        await self.__sync_rasp_generation()
+        return await self.fetch_rasp(entity)
+
+    @cache(ttl=60, stale_ttl=600)
+    async def fetch_rasp(self, entity: RaspEntity) -> Timetable:
+        # a fetch started before an invalidation may return the old page, so callers after it start their own
+        return await self.__rasp_flight.do((entity.type, entity.id, Rasp.fetch_rasp.cache.generation), lambda: self.__fetch_rasp(entity))
+
+    async def __sync_rasp_generation(self, interval: float = 5):
+        # at most one state lookup per interval, not one per timetable
+        if time.monotonic() - self.__rasp_generation_checked < interval:
+            return
+        self.__rasp_generation_checked = time.monotonic()
+        try:
+            generation = await self.__rasp_generation.get('generation', 0)
+        except Exception as e:
+            logging.warning('rasp generation check failed: %s', repr(e))
+            return
+        if generation != self.__rasp_generation_seen:
+            self.__rasp_generation_seen = generation
+            Rasp.fetch_rasp.cache.clear()
+
+    async def invalidate_rasp(self, entity: RaspEntity | None = None):
+        if entity is None:
+            Rasp.fetch_rasp.cache.clear()
+            try:
+                generation = await self.__rasp_generation.get('generation', 0) + 1
+                await self.__rasp_generation.set('generation', generation)
+                self.__rasp_generation_seen = generation
+            except Exception as e:
+                logging.warning('rasp generation bump failed: %s', repr(e))
+        else:
+            Rasp.fetch_rasp.invalidate(self, entity)
 
-        return pair
+    async def __fetch_rasp(self, entity: RaspEntity) -> Timetable:
+        html_page = (await fetcher.get(self.__url.format(entity.type.value, entity.id), headers=headers)).content
+        return await parse_service.run(parse_rasp, html_page)
 
-class Journal:
+class JournalSession:
     __login_page = 'http://ej.kbp.by/templates/login_parent.php'
     __ajax_page = 'http://ej.kbp.by/ajax.php'
     __journal_page = 'http://ej.kbp.by/templates/parent_journal.php'
     __logout_page = 'http://ej.kbp.by/index.php?logout'
 
-    monthlabels = {'январь': '01', 'февраль': '02', 'март': '03', 'апрель': '04', 'май': '05', 'июнь': '06', 'июль': '07', 'август': '08', 'сентябрь': '09', 'октябрь': '10', 'ноябрь': '11', 'декабрь': '12'}
+    def __init__(self, surname: str, group: str | int, birth: str, ttl: float):
+        self.surname = surname
+        self.group = group
+        self.birth = birth
+        self.expires = time.monotonic() + ttl
+        self.__cookie: dict[str, str] | None = None
+        self.__content: bytes | None = None
+        self.__fingerprint: str | None = None
+        self.__data: JournalData | None = None
+        self.__lock = asyncio.Lock()
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
 
-    def __login(self, surname: str, group: str | int, birth: str) -> dict[str, str] | None:
-        res = requests.get(self.__login_page, headers=headers)
+    async def __login(self) -> dict[str, str] | None:
+        res = await fetcher.get(self.__login_page, headers=headers)
         cookie = {'Cookie': res.headers['Set-Cookie'].split(';')[0]}
         s_code = html.parse(BytesIO(res.content)).getroot().get_element_by_id('S_Code').value
-        data = {'action': 'login_parent', 'student_name': surname, 'group_id': group, 'birth_day': birth, 'S_Code': s_code}
-        res = requests.post(self.__ajax_page, data=data, headers=headers|cookie)
+        data = {'action': 'login_parent', 'student_name': self.surname, 'group_id': self.group, 'birth_day': self.birth, 'S_Code': s_code}
+        res = await fetcher.post(self.__ajax_page, data=data, headers=headers|cookie)
         if res.text == 'good':
             return cookie
         else:
             return None
 
-    def get_ej(self, surname, group, birth) -> list[Mark] | None:
-        cookie = self.__login(surname, group, birth)
-        if cookie is None:
-            return None
-        marks = []
-        with open('ej.html', 'wb') as f:
-            f.write(requests.get(self.__journal_page, headers=headers|cookie|{'Referer': self.__journal_page}).content)
-        page = html.parse(BytesIO(requests.get(self.__journal_page, headers=headers|cookie|{'Referer': self.__journal_page}).content), parser=html.HTMLParser(encoding='utf-8'))
-        names = page.getroot().find_class('leftColumn').pop()
-        names_rows = names.cssselect('tr')[2:-1]
-        mark_table = page.getroot().find_class('rightColumn').pop()
-        months = mark_table.get_element_by_id('months').cssselect('td')[:-1]
-        months_nums = [int(m.get('colspan')) for m in months]
-        days = mark_table.get_element_by_id('dateOfMonth').cssselect('div')
-        mark_rows = mark_table.cssselect('tr')[2:-1]
-
-        for i in range(len(names_rows)):
-            name = names_rows[i].cssselect('div').pop().text_content().strip()
-            mark_columns = mark_rows[i].cssselect('td')[:-1]
-            for j in range(len(mark_columns)):
-                div = mark_columns[j].cssselect('div').pop()
-                spans = div.cssselect('span')
-                if len(spans) == 0:
-                    continue
-                mark = Mark()
-                mark.title = div.get('title')
-                mark.name = name
-                mark.day = str(days[j].text_content())
-                for k in range(len(months)):
-                    if j in range(sum(months_nums[:k+1])):
-                        mark.month = self.monthlabels[months[k].cssselect('div').pop().text_content()]
-                        break
-                for span in spans:
-                    mark.mark += ' ' + span.text_content()
-                mark.mark = mark.mark[1:]
-                marks.append(mark)
-
-        requests.get(self.__logout_page, headers=headers|cookie)
-        return marks
-
-    def get_average(self, surname, group, birth) -> list[Mark] | None:
-        cookie = self.__login(surname, group, birth)
-        if cookie is None:
-            return None
-        marks = []
-        page = html.parse(BytesIO(requests.get(self.__journal_page, headers=headers|cookie|{'Referer': self.__journal_page}).content), parser=html.HTMLParser(encoding='utf-8'))
-        names = page.getroot().find_class('leftColumn').pop()
-        names_rows = names.cssselect('tr')[2:-1]
-        mark_table = page.getroot().find_class('rightColumn').pop()
-        mark_rows = mark_table.cssselect('tr')[2:-1]
-        mark_columns = [row.cssselect('td').pop() for row in mark_rows]
+    async def __download(self) -> bytes | None:
+        if self.__content is None:
+            if self.__cookie is None:
+                self.__cookie = await self.__login()
+                if self.__cookie is None:
+                    return None
+            content = (await fetcher.get(self.__journal_page, headers=headers|self.__cookie|{'Referer': self.__journal_page})).content
+            ej_capture.capture('{} {} {}'.format(self.surname, self.group, self.birth), content)
+            self.__fingerprint = journal_fingerprint(content)
+            self.__content = content
+        return self.__content
+
+    async def fingerprint(self) -> str | None:
+        async with self.__lock:
+            if await self.__download() is None:
+                return None
+            return self.__fingerprint
+
+    async def journal(self) -> JournalData | None:
+        # marks and averages come from the same page, so it is downloaded and parsed once per session
+        async with self.__lock:
+            if self.__data is None:
+                content = await self.__download()
+                if content is None:
+                    return None
+                self.__data = await parse_service.run(parse_journal, content)
+            return self.__data
+
+    async def close(self):
+        async with self.__lock:
+            if self.__cookie is not None:
+                cookie, self.__cookie = self.__cookie, None
+                await fetcher.get(self.__logout_page, headers=headers|cookie)
 
-        sum = 0
-        count = 0
-        for i in range(len(names_rows)):
-            mark = Mark()
-            mark.name = names_rows[i].cssselect('div').pop().text_content().strip()
-            mark.mark = mark_columns[i].cssselect('div').pop().text_content().strip()
-            marks.append(mark)
-            if mark.mark != '-':
-                sum += float(mark.mark)
-                count += 1
-
-        general = Mark()
-        general.name = '\n**Общий**'
-        general.mark = str(round(sum / count, 1))
-        marks.append(general)
-
-        requests.get(self.__logout_page, headers=headers|cookie)
-        return marks
+class Journal:
+    def __init__(self, ttl: float = EJ_SESSION_TTL):
+        self.ttl = ttl
+        self.logins = 0
+        self.reuses = 0
+        self.__sessions: dict[tuple[str, str, str], JournalSession] = {}
+        self.__closing: set[asyncio.Task] = set()
+
+    def session(self, surname: str, group: str | int, birth: str) -> JournalSession:
+        key = (surname, str(group), birth)
+        session = self.__sessions.get(key)
+        if session is None or session.expired:
+            self.logins += 1
+            session = JournalSession(surname, group, birth, self.ttl)
+            self.__sessions[key] = session
+            asyncio.get_running_loop().call_later(self.ttl, self.__discard, key, session)
+        else:
+            self.reuses += 1
+        return session
+
+    def __discard(self, key: tuple[str, str, str], session: JournalSession):
+        if self.__sessions.get(key) is session:
+            self.__sessions.pop(key)
+        task = asyncio.create_task(self.__close(session))
+        self.__closing.add(task)
+        task.add_done_callback(self.__closing.discard)
+
+    async def __close(self, session: JournalSession):
+        try:
+            await session.close()
+        except Exception as e:
+            logging.error(e, exc_info=True)
+
+    async def get_journal(self, surname: str, group: str | int, birth: str) -> JournalData | None:
+        session = self.session(surname, group, birth)
+        key = (surname, str(group), birth)
+        try:
+            data = await session.journal()
+        except Exception:
+            self.__discard(key, session)
+            raise
+        if data is None:
+            self.__discard(key, session)
+        return data
+
+    async def get_new_ej(self, surname: str, group: str | int, birth: str, fingerprint: str | None) -> tuple[str, list[Mark] | None] | None:
+        # marks are only parsed when the journal's fingerprint differs from the known one
+        session = self.session(surname, group, birth)
+        key = (surname, str(group), birth)
+        try:
+            new_fingerprint = await session.fingerprint()
+            if new_fingerprint is None:
+                self.__discard(key, session)
+                return None
+            if new_fingerprint == fingerprint:
+                return new_fingerprint, None
+            data = await session.journal()
+        except Exception:
+            self.__discard(key, session)
+            raise
+        return new_fingerprint, data.marks
+
+    async def get_ej(self, surname: str, group: str | int, birth: str) -> list[Mark] | None:
+        data = await self.get_journal(surname, group, birth)
+        return data.marks if data is not None else None
+
+    async def get_average(self, surname: str, group: str | int, birth: str) -> list[Mark] | None:
+        data = await self.get_journal(surname, group, birth)
+        if data is not None and data.average is None:
+            raise ValueError('No averages on the journal page')
+        return data.average if data is not None else None
+
+    async def close(self):
+        logging.info('ej sessions: %d logins, %d reused', self.logins, self.reuses)
+        sessions = list(self.__sessions.values())
+        self.__sessions.clear()
+        await asyncio.gather(*(self.__close(session) for session in sessions), *self.__closing)
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from contextlib import closing
+import mysql.connector as mysql
+from apscheduler.schedulers.base import BaseScheduler
+from .config import SCHEDULER_LOCK
+from .db_utils import connect
+from .client import scheduler
+
+class SchedulerLeader:
+    # every process starts its scheduler paused, only the one holding the mysql named lock runs the jobs.
+    # the lock belongs to a connection, so when the leader dies mysql releases it and another process takes over
+    def __init__(self, scheduler: BaseScheduler, name: str, interval: float = 30, timeout: int = 5):
+        self.scheduler = scheduler
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.leader = False
+        self.__con: mysql.MySQLConnection | None = None
+        self.__task: asyncio.Task | None = None
+
+    def __hold(self) -> bool:
+        try:
+            if self.__con is None:
+                # not from the pool, the lock would take one of its few connections for good.
+                # a short timeout, an unreachable server must not keep the check waiting for the tcp one
+                self.__con = connect(connection_timeout=self.timeout)
+            with closing(self.__con.cursor()) as cur:
+                if self.leader:
+                    cur.execute('SELECT IS_USED_LOCK(%s) = CONNECTION_ID()', (self.name,))
+                else:
+                    cur.execute('SELECT GET_LOCK(%s, 0)', (self.name,))
+                return cur.fetchone()[0] == 1
+        except mysql.Error as e:
+            logging.warning('scheduler lock check failed: %s', repr(e))
+            self.__drop_connection()
+            return False
+
+    def __drop_connection(self):
+        if self.__con is not None:
+            try:
+                self.__con.close()
+            except mysql.Error:
+                pass
+            self.__con = None
+
+    async def __update(self):
+        # the lock check blocks on mysql, the loop keeps serving users meanwhile
+        leader = await asyncio.get_running_loop().run_in_executor(None, self.__hold)
+        if leader and not self.leader:
+            self.scheduler.resume()
+            logging.info('took the scheduler lock %s, running scheduled jobs', self.name)
+        elif not leader and self.leader:
+            self.scheduler.pause()
+            logging.warning('lost the scheduler lock %s, scheduled jobs paused', self.name)
+        self.leader = leader
+
+    async def __watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.__update()
+
+    async def start(self):
+        self.scheduler.start(paused=True)
+        await self.__update()
+        if not self.leader:
+            logging.info('scheduler lock %s is held by another process, waiting for it', self.name)
+        self.__task = asyncio.create_task(self.__watch())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+        if self.leader:
+            self.scheduler.pause()
+            try:
+                with closing(self.__con.cursor()) as cur:
+                    cur.execute('SELECT RELEASE_LOCK(%s)', (self.name,))
+                    cur.fetchone()
+            except mysql.Error as e:
+                logging.warning('scheduler lock release failed: %s', repr(e))
+        self.__drop_connection()
+        self.leader = False
+
+scheduler_leader = SchedulerLeader(scheduler, SCHEDULER_LOCK)
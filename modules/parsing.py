@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable
+from .config import PARSE_WORKERS, PARSE_MODE
+
+class ParseService:
+    def __init__(self, workers: int, mode: str = 'process'):
+        if mode not in ('process', 'thread'):
+            raise ValueError('Invalid parse mode: {}'.format(mode))
+        self.workers = workers
+        self.mode = mode
+        self.__executor: Executor | None = None
+
+    def __get_executor(self) -> Executor:
+        if self.__executor is None:
+            if self.mode == 'process':
+                # the pool starts after telethon and the executor threads, forking then could copy a held lock into the children
+                self.__executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+            else:
+                self.__executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='parse')
+        return self.__executor
+
+    async def run(self, parser: Callable, content: bytes):
+        loop = asyncio.get_running_loop()
+        executor = self.__get_executor()
+        try:
+            return await loop.run_in_executor(executor, parser, content)
+        except BrokenProcessPool:
+            # a crashed worker breaks the whole pool, so start a fresh one and try once more.
+            # parses failing together all land here, only the first one replaces the pool
+            if executor is self.__executor:
+                logging.warning('Parse pool is broken, restarting it')
+                self.shutdown()
+            return await loop.run_in_executor(self.__get_executor(), parser, content)
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+parse_service = ParseService(PARSE_WORKERS, PARSE_MODE)
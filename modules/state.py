@@ -0,0 +1,107 @@
+import asyncio
+import json
+import sqlite3
+import time
+import mysql.connector
+from contextlib import closing
+from functools import partial
+from typing import Any, Callable
+from .config import STATE_BACKEND, STATE_SQLITE_PATH
+from .db_utils import pool
+
+class MemoryStateBackend:
+    def __init__(self):
+        self.__values: dict[tuple[str, str], str] = {}
+
+    def get(self, namespace: str, key: str) -> str | None:
+        return self.__values.get((namespace, key))
+
+    def set(self, namespace: str, key: str, value: str):
+        self.__values[(namespace, key)] = value
+
+    def delete(self, namespace: str, key: str):
+        self.__values.pop((namespace, key), None)
+
+class SQLStateBackend:
+    # the queries run on both mysql and sqlite, which only differ in the placeholder
+    def __init__(self, connect: Callable, placeholder: str = '%s'):
+        self.connect = connect
+        self.placeholder = placeholder
+
+    def __execute(self, query: str, params: tuple = (), fetch: bool = False) -> list[tuple]:
+        with closing(self.connect()) as con:
+            with closing(con.cursor()) as cur:
+                cur.execute(query.replace('%s', self.placeholder), params)
+                rows = cur.fetchall() if fetch else []
+                con.commit()
+                return rows
+
+    def create_table(self):
+        self.__execute('CREATE TABLE IF NOT EXISTS `state` (`namespace` VARCHAR(32) NOT NULL, `key` VARCHAR(64) NOT NULL, `value` TEXT NOT NULL, PRIMARY KEY (`namespace`, `key`))')
+
+    def get(self, namespace: str, key: str) -> str | None:
+        rows = self.__execute('SELECT `value` FROM `state` WHERE `namespace` = %s AND `key` = %s', (namespace, key), fetch=True)
+        return rows[0][0] if len(rows) > 0 else None
+
+    def set(self, namespace: str, key: str, value: str):
+        self.__execute('REPLACE INTO `state` (`namespace`, `key`, `value`) VALUES (%s, %s, %s)', (namespace, key, value))
+
+    def delete(self, namespace: str, key: str):
+        self.__execute('DELETE FROM `state` WHERE `namespace` = %s AND `key` = %s', (namespace, key))
+
+    def claim(self, namespace: str, key: str) -> bool:
+        # the primary key lets only one process insert it, the value is when it did
+        try:
+            self.__execute('INSERT INTO `state` (`namespace`, `key`, `value`) VALUES (%s, %s, %s)', (namespace, key, str(int(time.time()))))
+            return True
+        except (mysql.connector.IntegrityError, sqlite3.IntegrityError):
+            return False
+
+    def prune(self, namespace: str, before: int):
+        # claim times have the same number of digits, so comparing them as text works on both databases
+        self.__execute('DELETE FROM `state` WHERE `namespace` = %s AND `value` < %s', (namespace, str(before)))
+
+def create_state_backend(name: str) -> MemoryStateBackend | SQLStateBackend:
+    match name:
+        case 'memory':
+            return MemoryStateBackend()
+        case 'mysql':
+            return SQLStateBackend(pool.get_connection)
+        case 'sqlite':
+            backend = SQLStateBackend(partial(sqlite3.connect, STATE_SQLITE_PATH), '?')
+            backend.create_table()
+            return backend
+        case _:
+            raise ValueError('Invalid state backend: {}'.format(name))
+
+state_backend = create_state_backend(STATE_BACKEND)
+
+class StateMap:
+    # values go through json in every backend, so code that works in memory works with sql too
+    def __init__(self, namespace: str, encode: Callable[[Any], Any] = lambda value: value, decode: Callable[[Any], Any] = lambda value: value, backend: MemoryStateBackend | SQLStateBackend | None = None):
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.backend = backend or state_backend
+
+    async def __run(self, func: Callable, *args) -> Any:
+        # sql queries block, they go to a thread so a slow database does not stall every handler
+        if isinstance(self.backend, MemoryStateBackend):
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def get(self, key: int, default: Any = None) -> Any:
+        value = await self.__run(self.backend.get, self.namespace, str(key))
+        return self.decode(json.loads(value)) if value is not None else default
+
+    async def pop(self, key: int, *default: Any) -> Any:
+        value = await self.get(key)
+        if value is None:
+            if len(default) == 0:
+                raise KeyError(key)
+            return default[0]
+        await self.__run(self.backend.delete, self.namespace, str(key))
+        return value
+
+    async def set(self, key: int, value: Any):
+        await self.__run(self.backend.set, self.namespace, str(key), json.dumps(self.encode(value), ensure_ascii=False))
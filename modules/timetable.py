@@ -0,0 +1,164 @@
+import hashlib
+from lxml import html, etree
+from io import BytesIO
+from enum import Enum
+from dataclasses import dataclass, field
+from .config import SCHEDULE
+
+class PairType(Enum):
+    DEFAULT = 'default'
+    REMOVED = 'removed'
+    EMPTY = 'empty'
+    ADDED = 'added'
+    CHANGED = 'changed'
+
+@dataclass(frozen=True, slots=True)
+class Pair:
+    time: str = ''
+    number: int = 0
+    type: PairType = PairType.EMPTY
+    names: tuple[str, ...] = ()
+    places: tuple[str, ...] = ()
+    teachers: tuple[str, ...] = ()
+    groups: tuple[str, ...] = ()
+
+@dataclass(frozen=True, slots=True)
+class Weekday:
+    __weeklabels = ('ПОНЕДЕЛЬНИК', 'ВТОРНИК', 'СРЕДА', 'ЧЕТВЕРГ', 'ПЯТНИЦА', 'СУББОТА')
+    number: int
+    zamena: str
+    pairs: tuple[Pair, ...] = ()
+
+    @property
+    def name(self) -> str:
+        return self.__weeklabels[self.number]
+
+@dataclass(frozen=True, slots=True)
+class Timetable:
+    left: tuple[Weekday, ...]
+    right: tuple[Weekday, ...]
+    # content hash, equal timetables fetched at different times share it
+    version: str = field(init=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'version', hashlib.blake2b(repr((self.left, self.right)).encode(), digest_size=8).hexdigest())
+
+    def __getitem__(self, week: str) -> tuple[Weekday, ...]:
+        match week:
+            case 'left':
+                return self.left
+            case 'right':
+                return self.right
+            case _:
+                raise KeyError('Invalid week: {}'.format(week))
+
+# descendant-or-self like lxml's find_class, which the cssselect parser used
+def class_xpath(class_name: str, boolean: bool = False) -> etree.XPath:
+    expression = 'descendant-or-self::*[contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(class_name)
+    return etree.XPath('boolean({})'.format(expression) if boolean else expression)
+
+week_xpath = etree.XPath('//*[@id = $id]')
+rows_xpath = etree.XPath('.//tr')
+header_cells_xpath = etree.XPath('.//th')
+cells_xpath = etree.XPath('.//td')
+has_pair_xpath = class_xpath('pair', boolean=True)
+pairs_xpath = class_xpath('pair')
+fields_xpath = etree.XPath('descendant-or-self::*[@class]')
+text_xpath = etree.XPath('string()', smart_strings=False)
+
+def parse_rasp(content: bytes) -> Timetable:
+    page = html.parse(BytesIO(content))
+    return Timetable(
+        left=get_week(week_xpath(page, id='left_week')[0]),
+        right=get_week(week_xpath(page, id='right_week')[0])
+    )
+
+def parse_rasp_list(content: bytes) -> list[tuple[int, str, str]]:
+    # (id, type label, name), the caller builds the entities so the parsing workers don't import db_utils
+    page = html.parse(BytesIO(content))
+    rasp_list = []
+
+    container = page.getroot().find_class('block_back')[0]
+    for entry in container.cssselect('div')[2:]:
+        label = entry.find_class('type_find')[0].text_content()
+        a = entry.cssselect('a')[0]
+        name = str(a.text_content())
+        id = int(a.get('href').split('=')[-1])
+        rasp_list.append((id, label, name))
+    return rasp_list
+
+def get_week(weekdiv: etree._Element) -> tuple[Weekday, ...]:
+    rows = rows_xpath(weekdiv)[1:-2]
+    zamena_cells = header_cells_xpath(rows[0])[1:-1]
+
+    zamena_labels: list[str] = []
+    pairs: list[list[Pair]] = []
+
+    for cell in zamena_cells:
+        zamena_label = text_xpath(cell).strip()
+        if zamena_label == 'Показать замены':
+            zamena_label = 'Замены:'
+        zamena_labels.append(zamena_label)
+        pairs.append([])
+
+    schedules = [SCHEDULE['thursday'] if i == 3 else SCHEDULE['saturday'] if i == 5 else SCHEDULE['regular'] for i in range(len(pairs))]
+
+    for row in rows[1:]:
+        if not has_pair_xpath(row):
+            continue
+        cells = cells_xpath(row)[:-1]
+        pair_number = int(text_xpath(cells[0]))
+        for i, cell in enumerate(cells[1:]):
+            pairs[i].append(extract_pair(cell, pair_number, schedules[i][pair_number - 1]))
+
+    return tuple(Weekday(i, zamena_label, tuple(day_pairs)) for i, (zamena_label, day_pairs) in enumerate(zip(zamena_labels, pairs)))
+
+def extract_pair(table_cell: etree._Element, number: int, time: str) -> Pair:
+    pair_divs = pairs_xpath(table_cell)
+
+    match len(pair_divs):
+        case 0:
+            return Pair(time, number)
+        case 1:
+            pair_div = pair_divs[0]
+            classes = pair_div.get('class').split()
+            if 'removed' in classes:
+                return Pair(time, number, PairType.REMOVED, ('Урок снят',))
+            elif 'added' in classes:
+                return extract_pair_data(pair_div, number, time, PairType.ADDED)
+            else:
+                return extract_pair_data(pair_div, number, time, PairType.DEFAULT)
+        case _:
+            classes = [pair_div.get('class').split() for pair_div in pair_divs]
+            if any('removed' in pair_classes for pair_classes in classes):
+                for pair_div, pair_classes in zip(pair_divs, classes):
+                    if 'added' in pair_classes:
+                        pair = extract_pair_data(pair_div, number, time, PairType.CHANGED)
+                        if pair.names[0] == 'Урок снят':
+                            return Pair(time, number, PairType.REMOVED, pair.names, pair.places[:-1], pair.teachers, pair.groups)
+                        return pair
+                return Pair(time, number, PairType.REMOVED, ('Урок снят',))
+            else:
+                names, places, teachers, groups = [], [], [], []
+                for pair_div in pair_divs:
+                    pair = extract_pair_data(pair_div, number, time, PairType.DEFAULT)
+                    names.extend(pair.names)
+                    places.extend(pair.places)
+                    teachers.extend(pair.teachers)
+                    groups.extend(pair.groups)
+                return Pair(time, number, PairType.DEFAULT, tuple(names), tuple(places), tuple(teachers), tuple(groups))
+
+def extract_pair_data(pair_div: etree._Element, number: int, time: str, type: PairType) -> Pair:
+    # one walk over the pair's fields instead of a class lookup per field
+    fields: dict[str, str] = {}
+    teachers: list[str] = []
+    for field in fields_xpath(pair_div):
+        for class_name in field.get('class').split():
+            if class_name == 'teacher':
+                teachers.append(text_xpath(field))
+            elif class_name in ('subject', 'place', 'group') and class_name not in fields:
+                fields[class_name] = text_xpath(field)
+
+    teachers = teachers[:1] if teachers[1] == '' else teachers[:2]
+
+    return Pair(time, number, type, (fields['subject'],), (fields['place'],), tuple(teachers), (fields['group'],))
@@ -1,31 +1,163 @@
-from functools import lru_cache, wraps
+from functools import wraps, lru_cache
+import asyncio
+import logging
 import time
 from copy import deepcopy
+from collections import OrderedDict
+from inspect import iscoroutinefunction
+from typing import Any, Awaitable, Callable, Hashable
 from enum import Enum, Flag
-from itertools import zip_longest
 
-def cache(maxsize: int = 128, typed: bool = False, copy: bool = False, ttl: int = 60):
+class CacheState(Enum):
+    MISS = 'miss'
+    FRESH = 'fresh'
+    STALE = 'stale'
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = 128, ttl: float = 60, stale_ttl: float = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation, values computed before it must not be stored
+        self.generation = 0
+        self.__entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def lookup(self, key: Hashable) -> tuple[CacheState, Any]:
+        if key not in self.__entries:
+            self.misses += 1
+            return CacheState.MISS, None
+        value, stored_at = self.__entries[key]
+        age = time.monotonic() - stored_at
+        if age < self.ttl:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return CacheState.FRESH, value
+        if age < self.ttl + self.stale_ttl:
+            self.__entries.move_to_end(key)
+            self.stale_hits += 1
+            return CacheState.STALE, value
+        del self.__entries[key]
+        self.misses += 1
+        return CacheState.MISS, None
+
+    def set(self, key: Hashable, value: Any):
+        self.__entries[key] = (value, time.monotonic())
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.generation += 1
+        self.__entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self.__entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self.__entries), 'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses, 'evictions': self.evictions}
+
+def cache(maxsize: int = 128, copy: bool = False, ttl: float = 60, stale_ttl: float = 0):
     def decorator(func):
-        @lru_cache(maxsize=maxsize, typed=typed)
-        def cached_func(*args, ttl_hash, **kwargs):
-            del ttl_hash
-            return func(*args, **kwargs)
+        if stale_ttl > 0 and not iscoroutinefunction(func):
+            # a stale value is served while a background task refreshes it, which needs a coroutine
+            raise ValueError('stale_ttl needs a coroutine function: {}'.format(func.__qualname__))
+        store = TTLCache(func.__qualname__, maxsize, ttl, stale_ttl)
+        refreshing: dict[Hashable, asyncio.Task] = {}
+
+        def make_key(args, kwargs) -> Hashable:
+            return (args, tuple(sorted(kwargs.items())))
+
+        def result(value):
+            return deepcopy(value) if copy else value
+
+        async def refresh(key: Hashable, args, kwargs):
+            generation = store.generation
+            try:
+                value = await func(*args, **kwargs)
+                if store.generation == generation:
+                    store.set(key, value)
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            finally:
+                refreshing.pop(key)
+                logging.info('%s cache refreshed: %s', store.name, store.stats())
 
         @wraps(func)
-        def wrapper(*args, **kwargs):
-            return cached_func(*args, ttl_hash=round(time.time() / ttl), **kwargs)
+        async def async_wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            state, value = store.lookup(key)
+            match state:
+                case CacheState.FRESH:
+                    return result(value)
+                case CacheState.STALE:
+                    # serve the old value right away and update it in the background
+                    if key not in refreshing:
+                        refreshing[key] = asyncio.ensure_future(refresh(key, args, kwargs))
+                    return result(value)
+            generation = store.generation
+            value = await func(*args, **kwargs)
+            if store.generation == generation:
+                store.set(key, value)
+            return result(value)
 
         @wraps(func)
-        def wrapper_with_copy(*args, **kwargs):
-            return deepcopy(cached_func(*args, ttl_hash=round(time.time() / ttl), **kwargs))
-        
-        if copy:
-            return wrapper_with_copy
-        else:
-            return wrapper
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            state, value = store.lookup(key)
+            if state != CacheState.FRESH:
+                generation = store.generation
+                value = func(*args, **kwargs)
+                if store.generation == generation:
+                    store.set(key, value)
+            return result(value)
+
+        wrapper = async_wrapper if iscoroutinefunction(func) else wrapper
+        wrapper.cache = store
+        wrapper.invalidate = lambda *args, **kwargs: store.invalidate(make_key(args, kwargs))
+        return wrapper
 
     return decorator
 
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.fetches = 0
+        self.callers = 0
+        self.__tasks: dict[Hashable, asyncio.Future] = {}
+        self.__waiters: dict[Hashable, int] = {}
+
+    @property
+    def saved(self) -> int:
+        return self.callers - self.fetches
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        self.callers += 1
+        if key in self.__tasks:
+            self.__waiters[key] += 1
+        else:
+            self.fetches += 1
+            self.__waiters[key] = 1
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self.__finish(key))
+            self.__tasks[key] = task
+        # a cancelled caller must not cancel the fetch the others are waiting for
+        return await asyncio.shield(self.__tasks[key])
+
+    def __finish(self, key: Hashable):
+        self.__tasks.pop(key)
+        waiters = self.__waiters.pop(key)
+        logging.info('%s %s: one fetch served %d callers (%d fetches for %d callers in total)', self.name, key, waiters, self.fetches, self.callers)
+
 class MessagePaneDirection(Enum):
     VERTICAL = 'vertical'
     HORIZONTAL = 'horizontal'
@@ -40,11 +172,48 @@ class MessageModifierFlag(Flag):
     ITALIC = 2
     STRIKETHROUGH = 4
 
+@lru_cache(maxsize=None)
+def padding(spacer: str, count: int) -> str:
+    return spacer * count
+
+@lru_cache(maxsize=None)
+def markers(modifiers: MessageModifierFlag) -> tuple[str, str]:
+    prefix, suffix = '', ''
+    if MessageModifierFlag.BOLD in modifiers:
+        prefix, suffix = '**' + prefix, suffix + '**'
+    if MessageModifierFlag.ITALIC in modifiers:
+        prefix, suffix = '__' + prefix, suffix + '__'
+    if MessageModifierFlag.STRIKETHROUGH in modifiers:
+        prefix, suffix = '~~' + prefix, suffix + '~~'
+    return prefix, suffix
+
+def trim_line(out: list[str], chars: str):
+    # strips the current line of the buffer like str.rstrip would strip it once the message is joined
+    while len(out) > 0:
+        piece = out[-1].rstrip(chars)
+        if piece != '':
+            out[-1] = piece
+            return
+        out.pop()
+
+def write_text(out: list[str], text: str, trim: str):
+    if trim != '' and '\n' in text:
+        lines = text.split('\n')
+        for line in lines[:-1]:
+            out.append(line)
+            trim_line(out, trim)
+            out.append('\n')
+        out.append(lines[-1])
+    else:
+        out.append(text)
+
 class MessageContent:
     def content_length(self) -> int:
         pass
     def render(self):
         pass
+    def write(self, out: list[str], trim: str = ''):
+        pass
 
 class TextMessageContent(MessageContent):
     def __init__(self, text: str, constraint: MessageContentConstraint = MessageContentConstraint.PLAIN, modifiers: MessageModifierFlag = MessageModifierFlag.NONE):
@@ -56,14 +225,17 @@ class TextMessageContent(MessageContent):
         return len(self.text)
 
     def render(self) -> str:
-        text = self.text
-        if MessageModifierFlag.BOLD in self.modifiers:
-            text = '**' + text + '**'
-        if MessageModifierFlag.ITALIC in self.modifiers:
-            text = '__' + text + '__'
-        if MessageModifierFlag.STRIKETHROUGH in self.modifiers:
-            text = '~~' + text + '~~'
-        return text
+        if self.modifiers is MessageModifierFlag.NONE:
+            return self.text
+        prefix, suffix = markers(self.modifiers)
+        return prefix + self.text + suffix
+
+    def write(self, out: list[str], trim: str = ''):
+        text = self.render()
+        if trim != '' and '\n' in text:
+            write_text(out, text, trim)
+        else:
+            out.append(text)
 
 class MessagePane(MessageContent):
     def __init__(self, direction: MessagePaneDirection, size: int = 0, constraint: MessageContentConstraint = MessageContentConstraint.PLAIN):
@@ -91,6 +263,9 @@ class MessagePane(MessageContent):
     def __len__(self):
         return len(self.__content)
 
+    def __iter__(self):
+        return iter(self.__content)
+
     def content_length(self) -> int:
         match self.direction:
             case MessagePaneDirection.VERTICAL:
@@ -98,39 +273,42 @@ class MessagePane(MessageContent):
             case MessagePaneDirection.HORIZONTAL:
                 return sum([content.content_length() for content in self.__content])
 
-    def render(self) -> str:
-        message = ''
+    def render(self, trim: str = '') -> str:
+        # trim: characters stripped from the end of every line, as the lines are written
+        out: list[str] = []
+        self.write(out, trim)
+        if trim != '':
+            trim_line(out, trim)
+        return ''.join(out)
+
+    def write(self, out: list[str], trim: str = ''):
+        vertical = self.direction == MessagePaneDirection.VERTICAL
+        spacer = '\n' if vertical else '⠀'
+
+        # every child is measured once, and the free space is shared between the fill children
         fill_content_count = 0
+        length = 0
         for content in self.__content:
-            if content.constraint == MessageContentConstraint.FILL:
+            if content.constraint is MessageContentConstraint.FILL:
                 fill_content_count += 1
-
-        spacings = []
+            if not vertical:
+                length += content.content_length()
         if fill_content_count != 0:
-            space, mod = divmod(self.size - self.content_length(), fill_content_count)
-            spacings = [s + r for s, r in zip_longest([space for _ in range(fill_content_count)], [1 for _ in range(mod)], fillvalue=0)]
-
-        for content in self.__content:
-            spacer = ''
-            match self.direction:
-                case MessagePaneDirection.VERTICAL:
-                    spacer = '\n'
-                case MessagePaneDirection.HORIZONTAL:
-                    spacer = '⠀'
-
-            match content.constraint:
-                case MessageContentConstraint.PLAIN:
-                    message += content.render()
-                case MessageContentConstraint.FILL:
-                    spacing = spacings.pop(0)
-                    message += spacer * (spacing // 2 + spacing % 2)
-                    message += content.render()
-                    message += spacer * (spacing // 2)
-
-            if self.direction == MessagePaneDirection.VERTICAL:
-                message += '\n'
-
-        if self.direction == MessagePaneDirection.VERTICAL:
-            message = message[:-1]
-        return message
+            space, mod = divmod(self.size - (len(self.__content) if vertical else length), fill_content_count)
 
+        fill_index = 0
+        for i, content in enumerate(self.__content):
+            if vertical and i > 0:
+                if trim != '':
+                    trim_line(out, trim)
+                out.append('\n')
+            if content.constraint is MessageContentConstraint.FILL:
+                spacing = space + 1 if fill_index < mod else space
+                fill_index += 1
+                if spacing > 0:
+                    write_text(out, padding(spacer, spacing // 2 + spacing % 2), trim)
+                content.write(out, trim)
+                if spacing > 1:
+                    write_text(out, padding(spacer, spacing // 2), trim)
+            else:
+                content.write(out, trim)
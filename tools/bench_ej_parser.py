@@ -0,0 +1,128 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from io import BytesIO
+from lxml import html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modules.journal import Mark, monthlabels, parse_ej, journal_fingerprint, right_column_tag
+
+# the cssselect based parser the bot used before modules.journal, kept as the reference implementation
+
+def parse_ej_cssselect(content: bytes) -> list[Mark]:
+    marks = []
+    page = html.parse(BytesIO(content), parser=html.HTMLParser(encoding='utf-8'))
+    names = page.getroot().find_class('leftColumn').pop()
+    names_rows = names.cssselect('tr')[2:-1]
+    mark_table = page.getroot().find_class('rightColumn').pop()
+    months = mark_table.get_element_by_id('months').cssselect('td')[:-1]
+    months_nums = [int(m.get('colspan')) for m in months]
+    days = mark_table.get_element_by_id('dateOfMonth').cssselect('div')
+    mark_rows = mark_table.cssselect('tr')[2:-1]
+
+    for i in range(len(names_rows)):
+        name = names_rows[i].cssselect('div').pop().text_content().strip()
+        mark_columns = mark_rows[i].cssselect('td')[:-1]
+        for j in range(len(mark_columns)):
+            div = mark_columns[j].cssselect('div').pop()
+            spans = div.cssselect('span')
+            if len(spans) == 0:
+                continue
+            mark = Mark()
+            mark.title = div.get('title')
+            mark.name = name
+            mark.day = str(days[j].text_content())
+            for k in range(len(months)):
+                if j in range(sum(months_nums[:k+1])):
+                    mark.month = monthlabels[months[k].cssselect('div').pop().text_content()]
+                    break
+            for span in spans:
+                mark.mark += ' ' + span.text_content()
+            mark.mark = mark.mark[1:]
+            marks.append(mark)
+
+    return marks
+
+# the fingerprint lets the bot skip unchanged journals, so a new mark must change it,
+# also when the column names appear before the columns themselves
+
+decoy = b'<style>.leftColumn, .rightColumn { float: left }</style><script>var columns = "leftColumn rightColumn </table>";</script>'
+
+def fingerprint_follows_marks(content: bytes) -> bool:
+    right = right_column_tag.search(content)
+    if right is None:
+        return True
+    position = content.find(b'</span>', right.start())
+    if position == -1:
+        return True
+    changed = content[:position] + b'0' + content[position:]
+    if parse_ej(changed) == parse_ej(content):
+        return True
+    return all(journal_fingerprint(prefix + changed) != journal_fingerprint(prefix + content) for prefix in (b'', decoy))
+
+# journal pages contain personal data, so a full school year with the same markup can be generated instead
+
+def generate_journal(seed: int, subjects: int, columns_per_month: int) -> bytes:
+    rng = random.Random(seed)
+    months = ['сентябрь', 'октябрь', 'ноябрь', 'декабрь', 'январь', 'февраль', 'март', 'апрель', 'май', 'июнь']
+    names = ['Предмет {}'.format(i) for i in range(subjects)]
+    columns = columns_per_month * len(months)
+
+    left = ''.join('<tr><td><div>{} </div></td></tr>'.format(name) for name in names)
+    month_row = ''.join('<td colspan="{}"><div>{}</div></td>'.format(columns_per_month, month) for month in months)
+    day_row = ''.join('<td><div>{:02d}</div></td>'.format(column % 28 + 1) for column in range(columns))
+    rows = ''
+    for name in names:
+        cells = ''
+        for column in range(columns):
+            if rng.random() < 0.25:
+                spans = ''.join('<span>{}</span>'.format(rng.randint(1, 10)) for _ in range(rng.choice((1, 1, 2))))
+                cells += '<td><div title="Тема {}">{}</div></td>'.format(column, spans)
+            else:
+                cells += '<td><div></div></td>'
+        rows += '<tr>{}<td><div> {:.1f} </div></td></tr>'.format(cells, rng.uniform(4, 10))
+
+    return (
+        '<html><head><meta charset="utf-8"></head><body>'
+        '<div class="leftColumn"><table><tr><td></td></tr><tr><td></td></tr>{}<tr><td></td></tr></table></div>'
+        '<div class="rightColumn"><table><tr id="months">{}<td></td></tr><tr id="dateOfMonth">{}<td></td></tr>{}<tr><td></td></tr></table></div>'
+        '</body></html>'
+    ).format(left, month_row, day_row, rows).encode()
+
+parser = argparse.ArgumentParser(description='Compare the journal mark parser with the previous cssselect parser on saved or generated journal pages')
+parser.add_argument('pages', nargs='*', help='saved journal pages')
+parser.add_argument('-g', '--generate', type=int, default=0, help='number of generated full year journals')
+parser.add_argument('-s', '--subjects', type=int, default=15, help='subjects per generated journal')
+parser.add_argument('-c', '--columns', type=int, default=12, help='lesson columns per month in generated journals')
+parser.add_argument('-n', '--number', type=int, default=10, help='parses per measurement')
+args = parser.parse_args()
+
+pages: list[tuple[str, bytes]] = []
+for path in args.pages:
+    with open(path, 'rb') as f:
+        pages.append((path, f.read()))
+for i in range(args.generate):
+    pages.append(('generated #{}'.format(i), generate_journal(i, args.subjects, args.columns)))
+if len(pages) == 0:
+    parser.error('pass saved pages or --generate')
+
+total_old = 0
+total_new = 0
+for name, content in pages:
+    marks = parse_ej(content)
+    if marks != parse_ej_cssselect(content):
+        print(f'{name}: parsers disagree')
+        sys.exit(1)
+    if not fingerprint_follows_marks(content):
+        print(f'{name}: fingerprint does not change with the marks')
+        sys.exit(1)
+    old = min(timeit.repeat(lambda: parse_ej_cssselect(content), number=args.number, repeat=5)) / args.number
+    new = min(timeit.repeat(lambda: parse_ej(content), number=args.number, repeat=5)) / args.number
+    total_old += old
+    total_new += new
+    print(f'{name}: {len(marks)} marks, cssselect {old * 1000:.2f}ms, xpath {new * 1000:.2f}ms, {old / new:.1f}x')
+
+print(f'total: cssselect {total_old * 1000:.2f}ms, xpath {total_new * 1000:.2f}ms, {total_old / total_new:.1f}x')
@@ -0,0 +1,110 @@
+import argparse
+import os
+import sys
+import timeit
+from itertools import zip_longest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modules.utils import MessagePane, MessagePaneDirection, TextMessageContent, MessageContentConstraint, MessageModifierFlag, MessageContent
+
+# the string concatenating renderer MessagePane used before, kept as the reference implementation
+
+def render_legacy(content: MessageContent) -> str:
+    if isinstance(content, TextMessageContent):
+        text = content.text
+        if MessageModifierFlag.BOLD in content.modifiers:
+            text = '**' + text + '**'
+        if MessageModifierFlag.ITALIC in content.modifiers:
+            text = '__' + text + '__'
+        if MessageModifierFlag.STRIKETHROUGH in content.modifiers:
+            text = '~~' + text + '~~'
+        return text
+    message = ''
+    fill_content_count = 0
+    for child in content:
+        if child.constraint == MessageContentConstraint.FILL:
+            fill_content_count += 1
+
+    spacings = []
+    if fill_content_count != 0:
+        space, mod = divmod(content.size - content.content_length(), fill_content_count)
+        spacings = [s + r for s, r in zip_longest([space for _ in range(fill_content_count)], [1 for _ in range(mod)], fillvalue=0)]
+
+    for child in content:
+        spacer = ''
+        match content.direction:
+            case MessagePaneDirection.VERTICAL:
+                spacer = '\n'
+            case MessagePaneDirection.HORIZONTAL:
+                spacer = '⠀'
+
+        match child.constraint:
+            case MessageContentConstraint.PLAIN:
+                message += render_legacy(child)
+            case MessageContentConstraint.FILL:
+                spacing = spacings.pop(0)
+                message += spacer * (spacing // 2 + spacing % 2)
+                message += render_legacy(child)
+                message += spacer * (spacing // 2)
+
+        if content.direction == MessagePaneDirection.VERTICAL:
+            message += '\n'
+
+    if content.direction == MessagePaneDirection.VERTICAL:
+        message = message[:-1]
+    return message
+
+def trim_legacy(message: str) -> str:
+    text = ''
+    for line in message.split('\n'):
+        text += line.rstrip('⠀') + '\n'
+    return text
+
+def line(width: int, *contents: TextMessageContent) -> MessagePane:
+    pane = MessagePane(MessagePaneDirection.HORIZONTAL, size=width)
+    for content in contents:
+        pane.add(content)
+    return pane
+
+def fill(text: str, modifiers: MessageModifierFlag = MessageModifierFlag.NONE) -> TextMessageContent:
+    return TextMessageContent(text, MessageContentConstraint.FILL, modifiers)
+
+# the same layout format_rasp builds for a teacher, every pair split between two groups
+def teacher_day(pairs: int, show_timestamps: bool) -> MessagePane:
+    width = 32 if show_timestamps else 24
+    modifiers = [MessageModifierFlag.NONE, MessageModifierFlag.BOLD, MessageModifierFlag.BOLD | MessageModifierFlag.ITALIC, MessageModifierFlag.STRIKETHROUGH]
+    pane = MessagePane(MessagePaneDirection.VERTICAL)
+    pane.add(line(width, fill('18.03', MessageModifierFlag.BOLD)))
+    pane.add(line(width, fill('ПОНЕДЕЛЬНИК', MessageModifierFlag.BOLD)))
+    pane.add(TextMessageContent(''))
+    pane.add(line(width, fill('Замены:', MessageModifierFlag.BOLD)))
+    for number in range(1, pairs + 1):
+        pair = line(width)
+        if show_timestamps:
+            pair.add(TextMessageContent('[8:00]⠀⠀|⠀'))
+        pair.add(TextMessageContent('{}⠀'.format(number) + ('⠀' if number < 10 else '')))
+        pair.add(fill('Основы алгоритмизации', modifiers[number % len(modifiers)]))
+        pair.add(TextMessageContent('⠀[{}]'.format(200 + number)))
+        pane.add(pair)
+        group = line(width, *([] if show_timestamps else [TextMessageContent('⠀' * 7)]), fill(''), fill(''), fill(''), fill('Т-{}'.format(190 + number)))
+        pane.add(group)
+        pane.add(line(width, *([TextMessageContent('⠀' * 4)] if show_timestamps else []), fill(''), fill(''), fill(''), fill('ОАиП'), fill('⠀[{}]'.format(300 + number)), fill('')))
+        pane.add(line(width, *([] if show_timestamps else [TextMessageContent('⠀' * 7)]), fill(''), fill(''), fill(''), fill('Т-{}'.format(290 + number))))
+    pane.add(TextMessageContent(''))
+    pane.add(line(width, fill('Иванов И.И.', MessageModifierFlag.BOLD)))
+    return pane
+
+parser = argparse.ArgumentParser(description='Compare MessagePane rendering with the previous string concatenating renderer on a teacher day')
+parser.add_argument('-p', '--pairs', type=int, default=13, help='pairs in the day')
+parser.add_argument('-n', '--number', type=int, default=2000, help='renders per measurement')
+args = parser.parse_args()
+
+for show_timestamps in (False, True):
+    pane = teacher_day(args.pairs, show_timestamps)
+    if pane.render() != render_legacy(pane) or pane.render(trim='⠀') + '\n' != trim_legacy(render_legacy(pane)):
+        print('renderers disagree')
+        sys.exit(1)
+    old = min(timeit.repeat(lambda: trim_legacy(render_legacy(pane)), number=args.number, repeat=5)) / args.number
+    new = min(timeit.repeat(lambda: pane.render(trim='⠀') + '\n', number=args.number, repeat=5)) / args.number
+    print(f'{args.pairs} pairs, timestamps {"on" if show_timestamps else "off"}: legacy {old * 1e6:.1f}us, buffer {new * 1e6:.1f}us, {old / new:.1f}x')
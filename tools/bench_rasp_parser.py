@@ -0,0 +1,171 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from io import BytesIO
+from itertools import chain
+from dataclasses import replace
+from lxml import html
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from modules.config import SCHEDULE
+from modules.timetable import PairType, Pair, Weekday, Timetable, parse_rasp
+
+# the cssselect based parser the bot used before modules.timetable, kept as the reference implementation
+
+def parse_rasp_cssselect(content: bytes) -> Timetable:
+    page = html.parse(BytesIO(content))
+    return Timetable(
+        left=get_week(page.getroot().get_element_by_id('left_week')),
+        right=get_week(page.getroot().get_element_by_id('right_week'))
+    )
+
+def get_week(weekdiv: html.HtmlElement) -> tuple[Weekday, ...]:
+    rows = weekdiv.cssselect('tr')[1:-2]
+    zamena_row = rows.pop(0)
+    zamena_cells = zamena_row.cssselect('th')[1:-1]
+
+    zamena_labels: list[str] = []
+    pairs: list[list[Pair]] = []
+
+    for cell in zamena_cells:
+        zamena_label = cell.text_content().strip()
+        if zamena_label == 'Показать замены':
+            zamena_label = 'Замены:'
+        zamena_labels.append(zamena_label)
+        pairs.append([])
+
+    for row in rows:
+        if len(row.find_class('pair')) == 0:
+            continue
+        cells = row.cssselect('td')[:-1]
+        number_cell = cells.pop(0)
+        pair_number = int(number_cell.text_content())
+        for i, cell in enumerate(cells):
+            match i:
+                case 3:
+                    pair_time = SCHEDULE['thursday'][pair_number - 1]
+                case 5:
+                    pair_time = SCHEDULE['saturday'][pair_number - 1]
+                case _:
+                    pair_time = SCHEDULE['regular'][pair_number - 1]
+            pairs[i].append(replace(extract_pair(cell), number=pair_number, time=pair_time))
+
+    return tuple(Weekday(i, zamena_label, tuple(day_pairs)) for i, (zamena_label, day_pairs) in enumerate(zip(zamena_labels, pairs)))
+
+def extract_pair(table_cell: html.HtmlElement) -> Pair:
+    pair_divs = table_cell.find_class('pair')
+
+    match len(pair_divs):
+        case 0:
+            return Pair()
+        case 1:
+            pair_div = pair_divs[0]
+            if 'removed' in pair_div.classes:
+                return Pair(type=PairType.REMOVED, names=('Урок снят',))
+            elif 'added' in pair_div.classes:
+                return replace(extract_pair_data(pair_div), type=PairType.ADDED)
+            else:
+                return replace(extract_pair_data(pair_div), type=PairType.DEFAULT)
+        case _:
+            classes = chain.from_iterable(pair_div.classes for pair_div in pair_divs)
+            if 'removed' in classes:
+                for pair_div in pair_divs:
+                    if 'added' in pair_div.classes:
+                        pair = extract_pair_data(pair_div)
+                        if pair.names[0] == 'Урок снят':
+                            return replace(pair, type=PairType.REMOVED, places=pair.places[:-1])
+                        return replace(pair, type=PairType.CHANGED)
+                return Pair(type=PairType.REMOVED, names=('Урок снят',))
+            else:
+                pairs_data = [extract_pair_data(pair_div) for pair_div in pair_divs]
+                return Pair(
+                    type=PairType.DEFAULT,
+                    names=tuple(chain.from_iterable(p.names for p in pairs_data)),
+                    places=tuple(chain.from_iterable(p.places for p in pairs_data)),
+                    teachers=tuple(chain.from_iterable(p.teachers for p in pairs_data)),
+                    groups=tuple(chain.from_iterable(p.groups for p in pairs_data))
+                )
+
+def extract_pair_data(pair_div: html.HtmlElement) -> Pair:
+    teachers = pair_div.find_class('teacher')
+    teacher_names = (str(teachers[0].text_content()),)
+    second_teacher = str(teachers[1].text_content())
+    if second_teacher != '':
+        teacher_names += (second_teacher,)
+
+    return Pair(
+        names=(str(pair_div.find_class('subject')[0].text_content()),),
+        places=(str(pair_div.find_class('place')[0].text_content()),),
+        groups=(str(pair_div.find_class('group')[0].text_content()),),
+        teachers=teacher_names
+    )
+
+# two weeks with the markup of kbp.by, every kind of cell the parsers tell apart comes up on a few seeds
+
+def generate_cell(rng: random.Random) -> str:
+    def pair(classes: str = '', subject: str | None = None) -> str:
+        return (
+            '<div class="pair {}"><div class="subject">{}</div><div class="place">{}</div><div class="group">Т-{}</div>'
+            '<div class="teacher">Иванов И.И.</div><div class="teacher">{}</div></div>'
+        ).format(classes, subject or rng.choice(['Математика', 'Физика', 'ОИТ', 'Английский язык']), rng.randint(100, 400), rng.randint(1, 99), rng.choice(['', '', 'Петров П.П.']))
+
+    r = rng.random()
+    if r < 0.3:
+        return '<td></td>'
+    if r < 0.55:
+        return '<td>{}</td>'.format(pair())
+    if r < 0.62:
+        return '<td>{}</td>'.format(pair('added'))
+    if r < 0.67:
+        return '<td><div class="pair removed"></div></td>'
+    if r < 0.75:
+        return '<td>{}{}</td>'.format(pair('removed'), pair('added'))
+    if r < 0.8:
+        return '<td>{}{}</td>'.format(pair('removed'), pair('added', 'Урок снят'))
+    if r < 0.84:
+        return '<td>{}{}</td>'.format(pair('removed'), pair())
+    return '<td>{}{}</td>'.format(pair(), pair())
+
+def generate_week(rng: random.Random, id: str) -> str:
+    rows = ['<tr><th></th>{}<th></th></tr>'.format(''.join('<th>{}</th>'.format(day) for day in ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб')))]
+    rows.append('<tr><th></th>{}<th></th></tr>'.format(''.join('<th>{}</th>'.format(rng.choice(['Замен нет', 'Показать замены', ''])) for _ in range(6))))
+    for number in range(1, 14):
+        rows.append('<tr><td>{}</td>{}<td></td></tr>'.format(number, ''.join(generate_cell(rng) for _ in range(6))))
+    rows.append('<tr><td></td></tr><tr><td></td></tr>')
+    return '<div id="{}"><table>{}</table></div>'.format(id, ''.join(rows))
+
+def generate_timetable(seed: int) -> bytes:
+    rng = random.Random(seed)
+    return '<html><head><meta charset="utf-8"></head><body>{}{}</body></html>'.format(generate_week(rng, 'left_week'), generate_week(rng, 'right_week')).encode()
+
+parser = argparse.ArgumentParser(description='Compare the XPath timetable parser with the previous cssselect parser on saved or generated kbp.by pages, e.g. curl -o group.html "https://kbp.by/rasp/timetable/view_beta_kbp/?cat=group&id=10"')
+parser.add_argument('pages', nargs='*', help='saved timetable pages')
+parser.add_argument('-g', '--generate', type=int, default=0, help='number of generated timetables')
+parser.add_argument('-n', '--number', type=int, default=50, help='parses per measurement')
+args = parser.parse_args()
+
+pages: list[tuple[str, bytes]] = []
+for path in args.pages:
+    with open(path, 'rb') as f:
+        pages.append((path, f.read()))
+for i in range(args.generate):
+    pages.append(('generated #{}'.format(i), generate_timetable(i)))
+if len(pages) == 0:
+    parser.error('pass saved pages or --generate')
+
+total_old = 0
+total_new = 0
+for name, content in pages:
+    if parse_rasp(content) != parse_rasp_cssselect(content):
+        print(f'{name}: parsers disagree')
+        sys.exit(1)
+    old = min(timeit.repeat(lambda: parse_rasp_cssselect(content), number=args.number, repeat=5)) / args.number
+    new = min(timeit.repeat(lambda: parse_rasp(content), number=args.number, repeat=5)) / args.number
+    total_old += old
+    total_new += new
+    print(f'{name}: cssselect {old * 1000:.2f}ms, xpath {new * 1000:.2f}ms, {old / new:.1f}x')
+
+print(f'total: cssselect {total_old * 1000:.2f}ms, xpath {total_new * 1000:.2f}ms, {total_old / total_new:.1f}x')